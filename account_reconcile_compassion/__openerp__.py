@@ -44,6 +44,7 @@
         'view/reconcile_split_payment_wizard_view.xml',
         'view/change_attribution_wizard_view.xml',
         'view/account_invoice_view.xml',
+        'security/ir.model.access.csv',
         ],
     'qweb': ['static/src/xml/account_move_reconciliation.xml'],
     'demo': [],
@@ -12,3 +12,5 @@
 from . import bank_statement_line
 from . import statement_operation
 from . import move_line
+from . import invoice_line
+from . import reconcile_progress
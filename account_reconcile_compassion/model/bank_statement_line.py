@@ -14,6 +14,7 @@ from openerp.tools import mod10r, DEFAULT_SERVER_DATE_FORMAT as DF
 from openerp.addons.sponsorship_compassion.models.product import \
     GIFT_CATEGORY, GIFT_NAMES, SPONSORSHIP_CATEGORY
 
+from collections import defaultdict
 from datetime import datetime
 
 from openerp.addons.connector.queue.job import job, related_action
@@ -36,12 +37,32 @@ class bank_statement_line(models.Model):
     ##########################################################################
     #                             PUBLIC METHODS                             #
     ##########################################################################
+    @api.multi
+    def get_data_for_reconciliations(
+            self, excluded_ids=None, search_reconciliation_proposition=True):
+        """ Finds at once the statement lines for which no move line
+        can be proposed, in order to skip their proposition search. """
+        st_lines = self
+        if search_reconciliation_proposition:
+            st_lines = self.with_context(
+                no_proposition_ids=self._get_lines_without_proposition(
+                    self).ids)
+        return super(
+            bank_statement_line, st_lines).get_data_for_reconciliations(
+            excluded_ids, search_reconciliation_proposition)
+
     @api.model
     def get_reconciliation_proposition(self, st_line, excluded_ids=None):
         """ Never propose reconciliation when move_lines have not
-            the same reference.
+            the same reference, unless they are payable. The constraint
+            is given with context value proposition_line_id to the
+            candidate searches. The results are still filtered, as not
+            all searches of the account module receive the context.
         """
-        res = super(bank_statement_line, self).get_reconciliation_proposition(
+        if st_line.id in self.env.context.get('no_proposition_ids', []):
+            return []
+        res = super(bank_statement_line, self.with_context(
+            proposition_line_id=st_line.id)).get_reconciliation_proposition(
             st_line, excluded_ids)
         filtered_res = [data for data in res if data['ref'] == st_line.ref or
                         data['account_type'] == 'payable']
@@ -52,42 +73,95 @@ class bank_statement_line(models.Model):
             self, st_line, excluded_ids=None, str=False, offset=0, limit=None,
             count=False, additional_domain=None):
         """ Sort move lines according to Compassion criterias :
-            Move line for current month at first,
+            Move lines with the same reference at first,
+            Then move lines for current month,
             Then other move_lines, from the oldest to the newest.
+            This replaces the method of account module, in order to sort
+            the move lines in the query, before the pagination. Super is
+            not called : overrides of this method in other modules loaded
+            before this one are skipped, and must be ported here if needed.
+            The candidate domain still comes from
+            _domain_move_lines_for_reconciliation, which can be inherited.
         """
         # Propose up to 12 move lines for a complete year.
         if limit is not None and limit < 12:
             limit = 12
 
-        res_asc = super(
-            bank_statement_line, self).get_move_lines_for_reconciliation(
-            st_line, excluded_ids, str, offset, limit, count,
-            additional_domain)
-
-        # Sort results with date (current month at first)
-        res_sorted = list()
-        today = datetime.today().date()
-        for mv_line_dict in res_asc:
-            mv_date = datetime.strptime(
-                mv_line_dict['date_maturity'] or mv_line_dict['date'], DF)
-            if mv_date.month == today.month and mv_date.year == today.year:
-                res_sorted.insert(0, mv_line_dict)
-            else:
-                res_sorted.append(mv_line_dict)
-
-        # Put matching references at first
-        res_sorted = sorted(
-            res_sorted, key=lambda mvl_data: mvl_data['ref'] == st_line.ref,
-            reverse=True)
-        return res_sorted
+        mv_line_obj = self.env['account.move.line']
+        domain = self._domain_move_lines_for_reconciliation(
+            st_line, excluded_ids=excluded_ids, str=str,
+            additional_domain=additional_domain)
+        if self.env.context.get('proposition_line_id') == st_line.id:
+            domain += self._get_proposition_domain(st_line)
+
+        # In case of a partial reconciliation, only keep one line (the
+        # first whose amount is greater than the residual amount because
+        # it is presumably the invoice)
+        filtered_ids = list()
+        reconcile_partial_ids = list()
+        actual_offset = offset
+        while True:
+            lines = mv_line_obj.browse(self._search_ranked_move_lines(
+                st_line, domain, actual_offset, limit))
+            make_one_more_loop = False
+            for line in lines:
+                partial = line.reconcile_partial_id
+                if partial and (
+                        partial.id in reconcile_partial_ids or
+                        abs(line.debit - line.credit) <
+                        abs(line.amount_residual)):
+                    # One more loop is needed to fill the page
+                    make_one_more_loop = True
+                    continue
+                filtered_ids.append(line.id)
+                if partial:
+                    reconcile_partial_ids.append(partial.id)
+
+            if not limit or not make_one_more_loop or \
+                    len(filtered_ids) >= limit:
+                break
+            actual_offset += limit
+        lines = mv_line_obj.browse(
+            filtered_ids[:limit] if limit else filtered_ids)
+
+        if count:
+            return len(lines)
+
+        target_currency = st_line.currency_id or \
+            st_line.journal_id.currency or \
+            st_line.journal_id.company_id.currency_id
+        mv_lines = mv_line_obj.prepare_move_lines_for_reconciliation_widget(
+            lines, target_currency=target_currency, target_date=st_line.date)
+        has_no_partner = not st_line.partner_id
+        for mv_line_dict in mv_lines:
+            mv_line_dict['has_no_partner'] = has_no_partner
+        return mv_lines
 
     @api.model
     def process_reconciliations(self, mv_line_dicts):
-        """ Launch reconciliation in a job. """
+        """ Launch reconciliation in jobs. Statement lines of different
+        partners are reconciled in separate jobs, which can run in
+        parallel. A reconcile.progress record follows the jobs. """
         if self.env.context.get('async_mode', True):
             session = ConnectorSession.from_env(self.env)
-            process_reconciliations_job.delay(
-                session, self._name, mv_line_dicts)
+            chunks = self._group_reconciliations(mv_line_dicts)
+            statements = self.browse(
+                [data[0] for data in mv_line_dicts]).mapped('statement_id')
+            # Create the invoicers of the statements before the jobs, so
+            # that parallel jobs never write on the same statement.
+            invoicer_obj = self.env['recurring.invoicer']
+            for statement in statements.filtered(
+                    lambda s: not s.recurring_invoicer_id):
+                statement.write({'recurring_invoicer_id': invoicer_obj.create(
+                    {'source': self._name}).id})
+            progress = self.env['reconcile.progress'].create({
+                'statement_ids': [(6, 0, statements.ids)]})
+            job_uuids = [
+                process_reconciliations_job.delay(
+                    session, self._name, chunk, progress.id)
+                for chunk in chunks]
+            jobs = self.env['queue.job'].search([('uuid', 'in', job_uuids)])
+            progress.write({'job_ids': [(6, 0, jobs.ids)]})
         else:
             self._process_reconciliations(mv_line_dicts)
 
@@ -110,56 +184,157 @@ class bank_statement_line(models.Model):
     ##########################################################################
     @api.model
     def _process_reconciliations(self, mv_line_dicts):
-        super(bank_statement_line, self).process_reconciliations(
+        """ Generates the invoices of all statement lines at once before
+        reconciling them. """
+        self._generate_reconciliation_invoices(mv_line_dicts)
+        super(bank_statement_line, self.with_context(
+            reconciliation_invoices_done=True)).process_reconciliations(
                 mv_line_dicts)
 
+    @api.model
+    def _group_reconciliations(self, mv_line_dicts):
+        """ Splits the reconciliations into chunks that can be processed
+        independently : statement lines of the same partner, or with
+        counterparts in the same move (invoice), stay in the same chunk
+        and keep their order.
+        :param mv_line_dicts: list of (statement line id, move lines data)
+        :return: list of chunks, in the same format
+        """
+        st_lines = self.browse([data[0] for data in mv_line_dicts])
+        counterpart_ids = [
+            mv_line_dict['counterpart_move_line_id']
+            for data in mv_line_dicts for mv_line_dict in data[1]
+            if mv_line_dict.get('counterpart_move_line_id')]
+        counterpart_moves = dict()
+        for mv_line in self.env['account.move.line'].browse(counterpart_ids):
+            counterpart_moves[mv_line.id] = mv_line.move_id.id
+
+        # Union of the statement lines sharing a partner or a move
+        parents = dict()
+
+        def find(key):
+            while parents.setdefault(key, key) != key:
+                key = parents[key]
+            return key
+
+        for index, data in enumerate(mv_line_dicts):
+            keys = [('move', counterpart_moves[mv_line_dict[
+                'counterpart_move_line_id']])
+                for mv_line_dict in data[1]
+                if mv_line_dict.get('counterpart_move_line_id')]
+            partner = st_lines.browse(data[0]).partner_id
+            if partner:
+                keys.append(('partner', partner.id))
+            root = find(('line', index))
+            for key in keys:
+                parents[find(key)] = root
+
+        chunks = list()
+        chunk_indexes = dict()
+        for index, data in enumerate(mv_line_dicts):
+            root = find(('line', index))
+            if root not in chunk_indexes:
+                chunk_indexes[root] = len(chunks)
+                chunks.append(list())
+            chunks[chunk_indexes[root]].append(data)
+        return chunks
+
     @api.one
     def process_reconciliation(self, mv_line_dicts):
         """ Create invoice if product_id is set in move_lines
-        to be created. """
-        partner_invoices = dict()
-        partner_inv_data = dict()
-        old_counterparts = dict()
-        index = 0
-        for mv_line_dict in mv_line_dicts:
-            partner_id = self.partner_id.id
-            if mv_line_dict.get('product_id'):
-                # Create invoice
-                mv_line_dict['index'] = index
-                if partner_id in partner_inv_data:
-                    partner_inv_data[partner_id].append(mv_line_dict)
-                else:
-                    partner_inv_data[partner_id] = [mv_line_dict]
-            mv_line_id = mv_line_dict.get('counterpart_move_line_id')
-            if mv_line_id:
-                # An invoice exists for that partner, we will use it
-                # to put leftover amount in it, if any exists.
-                invoice = self.env['account.move.line'].browse(
-                    mv_line_id).invoice
-                if invoice and invoice.period_id.state != 'done':
-                    partner_invoices[partner_id] = invoice
-                    old_counterparts[invoice.id] = mv_line_id
-            index += 1
-
-        # Create invoice and update move_line_dicts to reconcile them.
-        for partner_id, partner_data in partner_inv_data.iteritems():
-            invoice = partner_invoices.get(partner_id)
-            new_counterpart = self._create_invoice_from_mv_lines(
-                partner_data, invoice)
-            for data in partner_data:
-                index = data.pop('index')
-                mv_line_dicts[index] = data
-            if invoice:
-                old_counterpart = old_counterparts[invoice.id]
-                for mv_line_dict in mv_line_dicts:
+        to be created. Context value reconciliation_invoices_done tells
+        that the invoices were already generated. """
+        if not self.env.context.get('reconciliation_invoices_done'):
+            self._generate_reconciliation_invoices(
+                [(self.id, mv_line_dicts)])
+
+        super(bank_statement_line, self).process_reconciliation(mv_line_dicts)
+
+    @api.model
+    def _generate_reconciliation_invoices(self, mv_line_dicts):
+        """ Creates the invoices for the move lines having a product, for
+        all given statement lines, and validates them in one batch. The move
+        lines data is updated to be reconciled with the new invoices.
+        :param mv_line_dicts: list of (statement line id, move lines data)
+        """
+        to_validate = list()
+        open_invoices = self._find_open_invoices([
+            (st_line_id, [mv_line_dict for mv_line_dict in line_dicts
+                          if mv_line_dict.get('product_id')])
+            for st_line_id, line_dicts in mv_line_dicts])
+        for st_line_id, line_dicts in mv_line_dicts:
+            st_line = self.browse(st_line_id)
+            inv_data = [mv_line_dict for mv_line_dict in line_dicts
+                        if mv_line_dict.get('product_id')]
+            if not inv_data:
+                continue
+            invoice = None
+            old_counterpart = None
+            for mv_line_dict in line_dicts:
+                mv_line_id = mv_line_dict.get('counterpart_move_line_id')
+                if mv_line_id:
+                    # An invoice exists for that partner, we will use it
+                    # to put leftover amount in it, if any exists.
+                    mv_line_invoice = self.env['account.move.line'].browse(
+                        mv_line_id).invoice
+                    if mv_line_invoice and \
+                            mv_line_invoice.period_id.state != 'done':
+                        invoice = mv_line_invoice
+                        old_counterpart = mv_line_id
+            new_invoice = st_line._create_invoice_from_mv_lines(
+                inv_data, invoice, open_invoices.get(
+                    st_line_id, self.env['account.invoice']))
+            if new_invoice:
+                to_validate.append(
+                    (new_invoice, line_dicts, inv_data, old_counterpart))
+
+        invoices = self.env['account.invoice']
+        for invoice, line_dicts, inv_data, old_counterpart in to_validate:
+            invoices |= invoice
+        if not invoices:
+            return invoices
+        invoices.button_compute()
+        invoices.signal_workflow('invoice_open')
+
+        # Update move_lines data
+        counterparts = self._get_invoice_counterparts(invoices)
+        for invoice, line_dicts, inv_data, old_counterpart in to_validate:
+            counterpart_id = counterparts.get(invoice.id)
+            for mv_line_dict in inv_data:
+                mv_line_dict['counterpart_move_line_id'] = counterpart_id
+                if 'sponsorship_id' in mv_line_dict:
+                    del mv_line_dict['sponsorship_id']
+            if old_counterpart:
+                for mv_line_dict in line_dicts:
                     counterpart = mv_line_dict.get('counterpart_move_line_id')
                     if counterpart == old_counterpart:
                         mv_line_dict[
-                            'counterpart_move_line_id'] = new_counterpart
-
-        super(bank_statement_line, self).process_reconciliation(mv_line_dicts)
+                            'counterpart_move_line_id'] = counterpart_id
+        return invoices
 
-    def _create_invoice_from_mv_lines(self, mv_line_dicts, invoice=None):
+    @api.model
+    def _get_invoice_counterparts(self, invoices):
+        """ Finds with one query the debit move line of each invoice.
+        :return: dict {invoice_id: move_line_id}
+        """
+        self.env.cr.execute("""
+            SELECT DISTINCT ON (inv.id) inv.id, ml.id
+            FROM account_invoice inv
+            JOIN account_move_line ml ON ml.move_id = inv.move_id
+            WHERE inv.id IN %s AND ml.debit > 0
+            ORDER BY inv.id, ml.id
+        """, (tuple(invoices.ids),))
+        return dict(self.env.cr.fetchall())
+
+    def _create_invoice_from_mv_lines(self, mv_line_dicts, invoice=None,
+                                      open_invoices=None):
+        """ Creates or updates a draft invoice with the move lines data.
+        The invoice is validated by _generate_reconciliation_invoices.
+        :param open_invoices: open invoices matching the move lines, if
+                              they were already searched
+        :return: the draft invoice, or nothing if an open invoice matching
+                 the move lines was found.
+        """
         # Get the attached recurring invoicer
         invoicer = self.statement_id.recurring_invoicer_id
         if not invoicer:
@@ -183,7 +358,8 @@ class bank_statement_line(models.Model):
 
         else:
             # Lookup for an existing open invoice matching the criterias
-            invoices = self._find_open_invoice(mv_line_dicts)
+            invoices = self._find_open_invoice(mv_line_dicts) if \
+                open_invoices is None else open_invoices
             if invoices:
                 # Get the bvr reference of the invoice or set it
                 invoice = invoices[0]
@@ -195,7 +371,7 @@ class bank_statement_line(models.Model):
                 self.write({
                     'ref': ref,
                     'invoice_id': invoice.id})
-                return True
+                return self.env['account.invoice']
 
             # Setup a new invoice if no existing invoice is found
             journal_id = self.env['account.journal'].search(
@@ -222,9 +398,14 @@ class bank_statement_line(models.Model):
             }
             invoice = self.env['account.invoice'].create(inv_data)
 
+        analytic_ids = dict()
         for mv_line_dict in mv_line_dicts:
             product = self.env['product.product'].browse(
                 mv_line_dict['product_id'])
+            if product.id not in analytic_ids:
+                analytic_ids[product.id] = self.env[
+                    'account.analytic.default'].account_get(
+                    product.id, self.partner_id.id).analytic_id.id
             sponsorship_id = mv_line_dict.get('sponsorship_id')
             if not sponsorship_id:
                 related_contracts = invoice.mapped('invoice_line.contract_id')
@@ -254,9 +435,7 @@ class bank_statement_line(models.Model):
                 # Remove analytic account from bank journal item:
                 # it is only useful in the invoice journal item
                 'account_analytic_id': mv_line_dict.pop(
-                    'analytic_account_id',
-                    self.env['account.analytic.default'].account_get(
-                        product.id, self.partner_id.id).analytic_id.id)
+                    'analytic_account_id', analytic_ids[product.id])
             }
 
             if product.categ_name in (
@@ -269,40 +448,191 @@ class bank_statement_line(models.Model):
             if contract:
                 invoice.partner_id = contract.partner_id
 
-        invoice.button_compute()
-        invoice.signal_workflow('invoice_open')
         self.ref = ref
+        return invoice
 
-        # Update move_lines data
-        counterpart_id = invoice.move_id.line_id.filtered(
-            lambda ml: ml.debit > 0).id
-        for mv_line_dict in mv_line_dicts:
-            mv_line_dict['counterpart_move_line_id'] = counterpart_id
-            if 'sponsorship_id' in mv_line_dict:
-                del mv_line_dict['sponsorship_id']
-        return counterpart_id
+    @api.model
+    def _domain_reconciliation_proposition(self, st_line, excluded_ids=None):
+        domain = super(
+            bank_statement_line, self)._domain_reconciliation_proposition(
+            st_line, excluded_ids)
+        if self.env.context.get('proposition_line_id') == st_line.id:
+            domain += self._get_proposition_domain(st_line)
+        return domain
+
+    @api.model
+    def _get_proposition_domain(self, st_line):
+        """ Move lines that can be proposed for the statement line. """
+        if st_line.ref:
+            return ['|', ('ref', '=', st_line.ref),
+                    ('account_id.type', '=', 'payable')]
+        return [('account_id.type', '=', 'payable')]
+
+    @api.model
+    def _get_lines_without_proposition(self, st_lines):
+        """ Returns the statement lines having neither an unreconciled move
+        line with the same reference, nor an unreconciled payable move line
+        of their partner (of any partner if they have none). """
+        refs = tuple(set(ref for ref in st_lines.mapped('ref') if ref))
+        ref_candidates = set()
+        if refs:
+            self.env.cr.execute("""
+                SELECT DISTINCT ref FROM account_move_line
+                WHERE ref IN %s AND reconcile_id IS NULL
+            """, (refs,))
+            ref_candidates = set(row[0] for row in self.env.cr.fetchall())
+
+        payable_query = """
+            SELECT DISTINCT l.partner_id
+            FROM account_move_line l
+            JOIN account_account a ON a.id = l.account_id
+            WHERE a.type = 'payable' AND l.reconcile_id IS NULL
+        """
+        partner_ids = tuple(st_lines.mapped('partner_id').ids)
+        payable_partners = set()
+        if partner_ids:
+            self.env.cr.execute(
+                payable_query + ' AND l.partner_id IN %s', (partner_ids,))
+            payable_partners = set(
+                row[0] for row in self.env.cr.fetchall())
+        if st_lines.filtered(lambda l: not l.partner_id):
+            self.env.cr.execute(payable_query + ' LIMIT 1')
+            if self.env.cr.fetchone():
+                payable_partners.add(False)
+
+        return st_lines.filtered(
+            lambda l: l.ref not in ref_candidates and
+            l.partner_id.id not in payable_partners)
+
+    @api.model
+    def _search_ranked_move_lines(self, st_line, domain, offset=0,
+                                  limit=None):
+        """ Search move lines of the domain, ranked for the reconciliation
+        of the statement line : same reference first, then the lines due
+        in the current month, then from the oldest to the newest.
+        :return: list of move line ids
+        """
+        mv_line_obj = self.env['account.move.line']
+        query = mv_line_obj._where_calc(domain)
+        mv_line_obj._apply_ir_rules(query, 'read')
+        from_clause, where_clause, where_params = query.get_sql()
+        sql = """
+            SELECT "account_move_line".id
+            FROM {0}
+            WHERE {1}
+            ORDER BY
+                COALESCE("account_move_line".ref = %s, false) DESC,
+                date_trunc('month', COALESCE(
+                    "account_move_line".date_maturity,
+                    "account_move_line".date)) =
+                date_trunc('month', %s::date) DESC,
+                "account_move_line".date_maturity ASC,
+                "account_move_line".id ASC
+        """.format(from_clause, where_clause or 'true')
+        params = where_params + [st_line.ref,
+                                 datetime.today().strftime(DF)]
+        if limit:
+            sql += ' LIMIT %s'
+            params.append(limit)
+        if offset:
+            sql += ' OFFSET %s'
+            params.append(offset)
+        self.env.cr.execute(sql, params)
+        return [row[0] for row in self.env.cr.fetchall()]
 
     def _find_open_invoice(self, mv_line_dicts):
         """ Find an open invoice that matches the statement line and which
         could be reconciled with. """
-        invoice_line_obj = self.env['account.invoice.line']
-        inv_lines = invoice_line_obj
-        for mv_line_dict in mv_line_dicts:
-            amount = mv_line_dict['credit']
-            inv_lines |= invoice_line_obj.search([
-                ('partner_id', '=', mv_line_dict.get('partner_id')),
-                ('state', 'in', ('open', 'draft')),
-                ('product_id', '=', mv_line_dict.get('product_id')),
-                ('price_subtotal', '=', amount)])
+        return self._find_open_invoices([(self.id, mv_line_dicts)]).get(
+            self.id, self.env['account.invoice'])
 
-        return inv_lines.mapped('invoice_id').filtered(
-            lambda i: i.amount_total == self.amount)
+    @api.model
+    def _find_open_invoices(self, mv_line_dicts):
+        """ Finds with one query the open or draft invoices matching the
+        statement lines : the invoice has a line with the partner, product
+        and amount of one of the move lines and its total is the amount of
+        the statement line. Invoices are sorted by due date.
+        :param mv_line_dicts: list of (statement line id, move lines data)
+        :return: dict {statement line id: account.invoice recordset}
+        """
+        values = {'partner': list(), 'no_partner': list()}
+        for st_line_id, line_dicts in mv_line_dicts:
+            st_amount = self.browse(st_line_id).amount
+            for mv_line_dict in line_dicts:
+                partner_id = mv_line_dict.get('partner_id')
+                if partner_id:
+                    values['partner'].append((
+                        st_line_id, partner_id, mv_line_dict.get('product_id'),
+                        mv_line_dict['credit'], st_amount))
+                else:
+                    values['no_partner'].append((
+                        st_line_id, mv_line_dict.get('product_id'),
+                        mv_line_dict['credit'], st_amount))
+
+        queries = list()
+        params = list()
+        if values['partner']:
+            placeholders = ', '.join(
+                ['(%s, %s, %s, %s, %s)'] * len(values['partner']))
+            queries.append("""
+                SELECT v.st_line_id, l.invoice_id, l.due_date
+                FROM (VALUES {0}) AS v(st_line_id, partner_id, product_id,
+                                       amount, st_amount)
+                JOIN account_invoice_line l
+                    ON l.partner_id = v.partner_id
+                    AND l.product_id = v.product_id
+                    AND l.price_subtotal = v.amount
+                JOIN account_invoice inv ON inv.id = l.invoice_id
+                WHERE l.state IN ('open', 'draft')
+                AND inv.amount_total = v.st_amount
+            """.format(placeholders))
+            params.extend(v for row in values['partner'] for v in row)
+        if values['no_partner']:
+            placeholders = ', '.join(
+                ['(%s, %s, %s, %s)'] * len(values['no_partner']))
+            queries.append("""
+                SELECT v.st_line_id, l.invoice_id, l.due_date
+                FROM (VALUES {0}) AS v(st_line_id, product_id, amount,
+                                       st_amount)
+                JOIN account_invoice_line l
+                    ON l.partner_id IS NULL
+                    AND l.product_id = v.product_id
+                    AND l.price_subtotal = v.amount
+                JOIN account_invoice inv ON inv.id = l.invoice_id
+                WHERE l.state IN ('open', 'draft')
+                AND inv.amount_total = v.st_amount
+            """.format(placeholders))
+            params.extend(v for row in values['no_partner'] for v in row)
+        if not queries:
+            return dict()
+
+        self.env.cr.execute("""
+            SELECT st_line_id, invoice_id
+            FROM ({0}) AS matches
+            GROUP BY st_line_id, invoice_id
+            ORDER BY st_line_id, min(due_date), invoice_id
+        """.format(' UNION ALL '.join(queries)), params)
+        invoice_ids = defaultdict(list)
+        for st_line_id, invoice_id in self.env.cr.fetchall():
+            invoice_ids[st_line_id].append(invoice_id)
+        invoice_obj = self.env['account.invoice']
+        return {st_line_id: invoice_obj.browse(ids)
+                for st_line_id, ids in invoice_ids.iteritems()}
 
 
 ##############################################################################
 #                            CONNECTOR METHODS                               #
 ##############################################################################
 def related_action_reconciliations(session, job):
+    if len(job.args) > 2 and job.args[2]:
+        return {
+            'name': _("Reconciliation progress"),
+            'type': 'ir.actions.act_window',
+            'res_model': 'reconcile.progress',
+            'view_type': 'form',
+            'view_mode': 'form',
+            'res_id': job.args[2],
+        }
     line_ids = [arg[0] for arg in job.args[1]]
     statement_lines = session.env[job.args[0]].browse(line_ids)
     statement_ids = statement_lines.mapped('statement_id').ids
@@ -320,6 +650,8 @@ def related_action_reconciliations(session, job):
 
 @job(default_channel='root.reconciliation')
 @related_action(action=related_action_reconciliations)
-def process_reconciliations_job(session, model_name, mv_line_dicts):
-    """Job for reconciling bank statment lines."""
+def process_reconciliations_job(session, model_name, mv_line_dicts,
+                                progress_id=None):
+    """Job for reconciling bank statment lines. progress_id is only used
+    by the related action. """
     session.env[model_name]._process_reconciliations(mv_line_dicts)
@@ -0,0 +1,30 @@
+# -*- encoding: utf-8 -*-
+##############################################################################
+#
+#    Copyright (C) 2026 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#    @author: agent <agent@local>
+#
+#    The licence is in the file __openerp__.py
+#
+##############################################################################
+
+from openerp import models
+
+
+class invoice_line(models.Model):
+    """ Adds an index used to find open invoices matching payments. """
+    _inherit = 'account.invoice.line'
+
+    def init(self, cr):
+        cr.execute("""
+            SELECT indexname FROM pg_indexes
+            WHERE indexname = 'account_invoice_line_open_product_index'
+        """)
+        if not cr.fetchone():
+            cr.execute("""
+                CREATE INDEX account_invoice_line_open_product_index
+                ON account_invoice_line
+                (partner_id, product_id, price_subtotal)
+                WHERE state IN ('open', 'draft')
+            """)
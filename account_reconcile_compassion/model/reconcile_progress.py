@@ -0,0 +1,58 @@
+# -*- encoding: utf-8 -*-
+##############################################################################
+#
+#    Copyright (C) 2026 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#    @author: agent <agent@local>
+#
+#    The licence is in the file __openerp__.py
+#
+##############################################################################
+
+from openerp import api, models, fields
+
+
+class reconcile_progress(models.Model):
+    """ Follows the jobs reconciling the statement lines validated
+    together in the reconciliation widget. """
+
+    _name = 'reconcile.progress'
+    _order = 'create_date desc'
+
+    ##########################################################################
+    #                                 FIELDS                                 #
+    ##########################################################################
+
+    statement_ids = fields.Many2many(
+        'account.bank.statement', string='Bank statements', readonly=True)
+    job_ids = fields.Many2many(
+        'queue.job', string='Reconciliation jobs', readonly=True)
+    job_count = fields.Integer(
+        'Reconciliation jobs', compute='_compute_jobs')
+    pending_jobs = fields.Integer('Running jobs', compute='_compute_jobs')
+    failed_jobs = fields.Integer('Failed jobs', compute='_compute_jobs')
+    state = fields.Selection(
+        [('progress', 'In progress'), ('failed', 'Failed'),
+         ('done', 'Done')], compute='_compute_jobs')
+
+    ##########################################################################
+    #                             FIELDS METHODS                             #
+    ##########################################################################
+
+    @api.one
+    @api.depends('job_ids.state')
+    def _compute_jobs(self):
+        """ The progress is read from the state of the jobs, so that the
+        parallel jobs never write on the progress record. """
+        jobs = self.job_ids
+        self.job_count = len(jobs)
+        self.failed_jobs = len(jobs.filtered(
+            lambda job: job.state == 'failed'))
+        self.pending_jobs = len(jobs.filtered(
+            lambda job: job.state != 'done')) - self.failed_jobs
+        if self.pending_jobs:
+            self.state = 'progress'
+        elif self.failed_jobs:
+            self.state = 'failed'
+        else:
+            self.state = 'done'
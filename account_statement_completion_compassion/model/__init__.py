@@ -11,6 +11,7 @@
 
 from . import statement
 from . import invoice
+from . import move_line
 from . import completion_rules
 
 # vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
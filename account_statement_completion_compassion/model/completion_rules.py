@@ -9,18 +9,50 @@
 #
 ##############################################################################
 
-from openerp import api, models, fields
+from openerp import api, models, fields, _
 from openerp.tools import DEFAULT_SERVER_DATE_FORMAT as DF
 from openerp.addons.sponsorship_compassion.models.product import \
     GIFT_CATEGORY, GIFT_NAMES
+from openerp.addons.recurring_contract.model.recurring_invoicer import \
+    VALIDATION_CHUNK_SIZE, validate_invoices_job
+from openerp.addons.connector.session import ConnectorSession
 
+from collections import defaultdict
 from datetime import datetime
+import re
 import time
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+class CompletionCache(object):
+    """ Memoizes the lookups made by the completion rules which give the
+    same answer for all lines of a statement import (products, journal,
+    analytic defaults). It is given to the rules with the context value
+    completion_cache and cleared when the import ends.
+    It also collects the data of the invoices to generate once all rules
+    were applied, and the lines matched by more than one partner, which
+    are reported to the user at the end of the import. """
+
+    def __init__(self):
+        self._values = dict()
+        self.invoices_data = list()
+        self.partner_conflicts = dict()
+
+    def get(self, key, compute):
+        """ Returns the value stored for key, computing it with the
+        compute function if it is not known yet. """
+        if key not in self._values:
+            self._values[key] = compute()
+        return self._values[key]
+
+    def clear(self):
+        self._values.clear()
+        self.invoices_data = list()
+        self.partner_conflicts = dict()
+
+
 class account_journal_completion(models.Model):
     """ Add completion rules to journals """
     _inherit = 'account.journal'
@@ -39,14 +71,58 @@ class account_bank_statement_import(models.TransientModel):
         )._create_bank_statement(
             stmt_vals
         )
-        for stmt_line in self.env['account.bank.statement'].browse(
-                statement_id).mapped('line_ids'):
-            fields_update = stmt_line.journal_id.\
-                completion_rules.auto_complete(stmt_line)
-            if fields_update:
-                stmt_line.write(fields_update)
+        stmt_lines = self.env['account.bank.statement'].browse(
+            statement_id).mapped('line_ids')
+        cache = CompletionCache()
+        try:
+            for journal in stmt_lines.mapped('journal_id'):
+                journal_lines = stmt_lines.filtered(
+                    lambda l: l.journal_id == journal)
+                fields_update = journal.completion_rules.with_context(
+                    completion_cache=cache).auto_complete_lines(journal_lines)
+                self._write_completion(journal_lines, fields_update)
+            self.env['account.statement.completion.rule']._generate_invoices(
+                cache.invoices_data)
+            notifs.extend(self._get_completion_notifs(cache))
+        finally:
+            cache.clear()
         return statement_id, notifs
 
+    def _get_completion_notifs(self, cache):
+        """ Notifications shown to the user about the lines that the
+        completion could not match with certainty. """
+        notifs = list()
+        conflicts = cache.partner_conflicts
+        if conflicts:
+            notifs.append({
+                'type': 'warning',
+                'message': _(
+                    "%d statement lines were matched by more than one "
+                    "partner and were not completed : %s") % (
+                    len(conflicts), ', '.join(
+                        '"%s" (Ref:%s, partners:%s)' % (
+                            conflict['name'], conflict['ref'],
+                            conflict['partner_ids'])
+                        for conflict in conflicts.itervalues())),
+                'details': {
+                    'name': _('Lines matching many partners'),
+                    'model': 'account.bank.statement.line',
+                    'ids': conflicts.keys(),
+                },
+            })
+        return notifs
+
+    def _write_completion(self, stmt_lines, fields_update):
+        """ Writes the completion results on the statement lines, with one
+        write for all lines receiving the same values.
+        :param fields_update: dict {line_id: values to write}
+        """
+        lines_by_vals = defaultdict(list)
+        for line_id, vals in fields_update.iteritems():
+            lines_by_vals[tuple(sorted(vals.items()))].append(line_id)
+        for vals, line_ids in lines_by_vals.iteritems():
+            stmt_lines.browse(line_ids).write(dict(vals))
+
 
 class StatementCompletionRule(models.Model):
     """ Add rules to complete account based on the BVR reference of the invoice
@@ -112,12 +188,36 @@ class StatementCompletionRule(models.Model):
 
             ...}
         """
+        return self.auto_complete_lines(stmt_line).get(stmt_line.id)
+
+    @api.multi
+    def auto_complete_lines(self, st_lines):
+        """ Batch version of auto_complete : the rules are executed in their
+        sequence order over all given statement lines, and each rule only
+        receives the lines that no previous rule could complete.
+        A rule can define a method named _batch_<function_to_call> that
+        completes all the remaining lines at once. Otherwise, the rule
+        is called for each line.
+        :param st_lines: account.bank.statement.line recordset
+        :return: dict {line_id: values to write on the statement line}
+        """
+        res = dict()
+        remaining = st_lines
         for rule in self.sorted(key=lambda r: r.sequence):
-            method = getattr(self, rule.function_to_call)
-            result = method(stmt_line)
-            if result:
-                return result
-        return None
+            if not remaining:
+                break
+            batch_method = getattr(
+                self, '_batch_' + rule.function_to_call, None)
+            if batch_method:
+                results = batch_method(remaining)
+            else:
+                method = getattr(self, rule.function_to_call)
+                results = {line.id: method(line) for line in remaining}
+            completed = remaining.filtered(lambda l: results.get(l.id))
+            for line in completed:
+                res[line.id] = results[line.id]
+            remaining -= completed
+        return res
 
     def get_from_partner_ref(self, st_line):
         """
@@ -131,28 +231,36 @@ class StatementCompletionRule(models.Model):
             'account_id' : value,
             ...}
         """
-        ref = st_line.ref
-        res = {}
+        return self._batch_get_from_partner_ref(st_line).get(st_line.id, {})
+
+    def _batch_get_from_partner_ref(self, st_lines):
+        """ Batch version of get_from_partner_ref. Lines matched by more
+        than one partner are reported together : during an import, they
+        are given to the user with the notifications of the import.
+        Otherwise, they are logged in one warning. """
+        res = dict()
+        partners, conflicts = self._match_partner_refs(st_lines)
         partner_obj = self.env['res.partner']
-        partner = partner_obj.search(
-            [('ref', '=', str(int(ref[9:16]))),
-             ('is_company', '=', False)])
-        # Test that only one partner matches.
-        if partner:
-            if len(partner) == 1:
+        for st_line in st_lines:
+            partner = partners.get(st_line.id)
+            if partner:
                 # If we fall under this rule of completion, it means there is
                 # no open invoice corresponding to the payment. We may need to
                 # generate one depending on the payment type.
-                res.update(
-                    self._generate_invoice(st_line, partner))
+                res[st_line.id] = self._generate_invoice(st_line, partner)
                 # Get the accounting partner (company)
                 partner = partner_obj._find_accounting_partner(partner)
-                res['partner_id'] = partner.id
-            else:
-                logger.warning(
-                    'Line named "%s" (Ref:%s) was matched by more '
-                    'than one partner while looking on partners' %
-                    (st_line['name'], st_line['ref']))
+                res[st_line.id]['partner_id'] = partner.id
+        if conflicts and 'completion_cache' in self.env.context:
+            self._get_completion_cache().partner_conflicts.update(conflicts)
+        elif conflicts:
+            logger.warning(
+                'Lines matched by more than one partner while looking on '
+                'partners : %s' % ', '.join(
+                    '"%s" (Ref:%s, partners:%s)' % (
+                        conflict['name'], conflict['ref'],
+                        conflict['partner_ids'])
+                    for conflict in conflicts.itervalues()))
         return res
 
     def get_from_bvr_ref(self, st_line):
@@ -188,120 +296,128 @@ class StatementCompletionRule(models.Model):
 
         return res
 
+    def _batch_get_from_bvr_ref(self, st_lines):
+        """ Batch version of get_from_bvr_ref. """
+        return self._complete_from_bvr_refs(st_lines)
+
+    def _batch_lsv_dd_get_from_bvr_ref(self, st_lines):
+        """ Batch version of lsv_dd_get_from_bvr_ref. """
+        return self._complete_from_bvr_refs(st_lines, True)
+
     def get_from_amount(self, st_line):
         """ If line amount match an open supplier invoice,
             update partner and account. """
-        amount = st_line.amount
-        res = {}
+        return self._batch_get_from_amount(st_line).get(st_line.id, {})
+
+    def _batch_get_from_amount(self, st_lines):
+        """ Batch version of get_from_amount. All open supplier invoices
+        matching one of the debit amounts are loaded with one search.
+        Context value amount_tolerance allows to match invoices whose
+        amount differs from the line amount by at most the tolerance. """
+        res = dict()
+        tolerance = self.env.context.get('amount_tolerance', 0.0)
         # We check only for debit entries
-        if amount < 0:
-            invoice_obj = self.env['account.invoice']
-            invoices = invoice_obj.search(
-                [('type', '=', 'in_invoice'), ('state', '=', 'open'),
-                 ('amount_total', '=', abs(amount))])
-            res = {}
-            partner_obj = self.pool.get('res.partner')
-            if invoices:
-                if len(invoices) == 1:
-                    partner = invoices.partner_id
-                    res['partner_id'] = partner_obj._find_accounting_partner(
-                        partner).id
-                else:
-                    partner = invoices[0].partner_id
-                    for invoice in invoices:
-                        if invoice.partner_id.id != partner.id:
-                            logger.warning(
-                                'Line named "%s" (Ref:%s) was matched by '
-                                'more than one invoice while looking on open'
-                                ' supplier invoices' %
-                                (st_line.name, st_line.ref))
-                    res['partner_id'] = partner_obj._find_accounting_partner(
-                        partner).id
+        debit_lines = st_lines.filtered(lambda l: l.amount < 0)
+        invoices_by_amount = self._get_open_supplier_invoices(
+            [abs(amount) for amount in debit_lines.mapped('amount')],
+            tolerance)
+        partner_obj = self.env['res.partner']
+        conflicts = list()
+        for st_line in debit_lines:
+            invoices = list()
+            for cents in self._get_amount_keys(abs(st_line.amount),
+                                               tolerance):
+                invoices.extend(invoices_by_amount.get(cents, []))
+            if not invoices:
+                continue
+            partner = invoices[0].partner_id
+            if any(invoice.partner_id != partner for invoice in invoices):
+                conflicts.append(st_line)
+            res[st_line.id] = {
+                'partner_id': partner_obj._find_accounting_partner(
+                    partner).id}
+        if conflicts:
+            logger.warning(
+                'Lines matched by more than one invoice while looking on '
+                'open supplier invoices : %s' % ', '.join(
+                    '"%s" (Ref:%s)' % (st_line.name, st_line.ref)
+                    for st_line in conflicts))
         return res
 
     def get_from_lsv_dd(self, st_line):
         """ If line is a LSV or DD credit, change the account to 1098. """
-        label = st_line.name.replace('\n', ' ') if st_line.name != '/' else \
-            st_line.ref.replace('\n', ' ')
-        lsv_dd_strings = [u'BULLETIN DE VERSEMENT ORANGE',
-                          u'ORDRE DEBIT DIRECT',
-                          u'Crèdit LSV']
-        is_lsv_dd = False
-        res = {}
-        for credit_string in lsv_dd_strings:
-            is_lsv_dd = is_lsv_dd or credit_string in label
-        if is_lsv_dd:
+        return self._batch_get_from_lsv_dd(st_line).get(st_line.id, {})
+
+    def _batch_get_from_lsv_dd(self, st_lines):
+        """ Batch version of get_from_lsv_dd. The labels are matched with
+        one regular expression built from _get_lsv_dd_strings and the
+        account is searched only once. """
+        res = dict()
+        credit_strings = self._get_lsv_dd_strings()
+        if not credit_strings:
+            # An empty pattern would match all labels
+            return res
+        lsv_dd_pattern = re.compile(u'|'.join(
+            re.escape(credit_string) for credit_string in credit_strings))
+        lsv_dd_lines = st_lines.filtered(
+            lambda l: lsv_dd_pattern.search(
+                (l.name if l.name != '/' else l.ref or '').replace(
+                    '\n', ' ')))
+        if lsv_dd_lines:
             account_id = self.env['account.account'].search(
-                [('code', '=', '1098')]).ids
+                [('code', '=', '1098')], limit=1).id
             if account_id:
-                res['account_id'] = account_id[0]
-
+                for st_line in lsv_dd_lines:
+                    res[st_line.id] = {'account_id': account_id}
         return res
 
     def get_from_move_line_ref(self, st_line):
         ''' Update partner if same reference is found '''
-        ref = st_line.ref
-        res = {}
-        partner = None
-
-        # Search move lines
-        move_line_obj = self.env['account.move.line']
-        move_lines = move_line_obj.search(
-            [('ref', '=', ref), ('partner_id', '!=', None)])
-        if move_lines:
-            partner = move_lines[0].partner_id
-
-        if partner:
-            partner_obj = self.env['res.partner']
-            partner = partner_obj._find_accounting_partner(partner)
-            res['partner_id'] = partner.id
+        return self._batch_get_from_move_line_ref(st_line).get(st_line.id, {})
 
+    def _batch_get_from_move_line_ref(self, st_lines):
+        """ Batch version of get_from_move_line_ref. """
+        res = dict()
+        partners = self._search_partners_by_move_line_refs(
+            st_lines.mapped('ref'))
+        partner_obj = self.env['res.partner']
+        for st_line in st_lines:
+            partner = partners.get(st_line.ref)
+            if partner:
+                partner = partner_obj._find_accounting_partner(partner)
+                res[st_line.id] = {'partner_id': partner.id}
         return res
 
     def get_sponsor_name(self, st_line):
-        res = {}
-        name = st_line.name
-        sender_lines = []
-
-        sender_lines.append(name.replace('\n', ' ').split(
-            ' EXPÉDITEUR: '.decode('utf8')))
-        sender_lines.append(name.replace('\n', ' ').split(
-            " DONNEUR D'ORDRE: ".decode('utf8')))
-
-        id_line1 = 1 if len(sender_lines[0]) > 1 else False
-        id_line2 = 2 if len(sender_lines[1]) > 1 else False
+        return self._batch_get_sponsor_name(st_line).get(st_line.id, {})
 
-        if not id_line1 and not id_line2:
+    def _batch_get_sponsor_name(self, st_lines):
+        """ Matches the sender name given in the label of the statement
+        lines with the names of the partners. The names of all candidate
+        partners are loaded once, and the lines are matched in memory. """
+        res = dict()
+        candidates = dict()
+        for st_line in st_lines:
+            names = self._get_sender_name_candidates(st_line.name)
+            if names:
+                candidates[st_line.id] = names
+        if not candidates:
             return res
 
-        id_line = id_line1-1 if id_line1 else id_line2-1
-        sender_line = sender_lines[id_line][1].replace(',', '').split(' ')
-
-        index = 0
-        for word in sender_line:
-            try:
-                if index < len(sender_line):
-                    int(word)
-                for i in range(index-1, 0, -1):
-                    firstname = sender_line[i-1]
-                    partner = self.env['res.partner'].search(
-                        [('lastname', '=ilike', firstname),
-                         ('firstname', 'ilike', sender_line[i])])
-                    lastnames = sender_line[i].split('-') if not partner else \
-                        []
-
-                    for lastname in lastnames:
-                        partner = self.env['res.partner'].search(
-                            [('lastname', '=ilike', lastname),
-                             ('firstname', 'ilike', firstname)]) or \
-                            self.env['res.partner'].search(
-                            [('lastname', '=ilike', firstname),
-                             ('firstname', 'ilike', lastname)])
-                    if partner:
-                        res['partner_id'] = partner.id
-                        return res
-            except:
-                index += 1
+        name_index = self._get_partner_name_index(set(
+            lastname for names in candidates.itervalues()
+            for lastname, firstname in names))
+        for line_id, names in candidates.iteritems():
+            for lastname, firstname in names:
+                partner_ids = [
+                    partner_id for partner_firstname, partner_id in
+                    name_index.get(lastname, [])
+                    if firstname in partner_firstname]
+                # Ambiguous names are skipped
+                if len(partner_ids) == 1:
+                    res[line_id] = {'partner_id': partner_ids[0]}
+                    break
+        return res
 
     ##########################################################################
     #                             PRIVATE METHODS                            #
@@ -343,8 +459,9 @@ class StatementCompletionRule(models.Model):
 
         # Setup invoice data
         invoicer_id = st_line.statement_id.recurring_invoicer_id.id
-        journal_id = self.env['account.journal'].search(
-            [('type', '=', 'sale')], limit=1).id
+        journal_id = self._get_completion_cache().get(
+            'sale_journal', lambda: self.env['account.journal'].search(
+                [('type', '=', 'sale')], limit=1).id)
         if not invoicer_id:
             invoicer_id = self.env['recurring.invoicer'].create(
                 {'source': st_line.statement_id._name}).id
@@ -359,39 +476,78 @@ class StatementCompletionRule(models.Model):
             'payment_term': 1,  # Immediate payment
             'bvr_reference': st_line.ref,
             'recurring_invoicer_id': invoicer_id,
+            'invoice_line': [(0, 0, self._setup_invoice_line_data(
+                product, st_line, partner.id))],
         }
+        res['name'] = product.name
 
-        # Create invoice and generate invoice lines
-        invoice = self.env['account.invoice'].with_context(
-            lang='en_US').create(inv_data)
-
-        res.update(self._generate_invoice_line(
-            invoice.id, product, st_line, partner.id))
-
-        invoice.signal_workflow('invoice_open')
+        if 'completion_cache' in self.env.context:
+            # Invoices are generated once all rules were applied
+            self._get_completion_cache().invoices_data.append(inv_data)
+        else:
+            self._generate_invoices([inv_data])
 
         return res
 
+    @api.model
+    def _generate_invoices(self, invoices_data):
+        """ Creates the invoices requested by the completion. By default,
+        they are validated after the import by jobs handling chunks of
+        validation_chunk_size (context value) invoices, which keeps the
+        import transaction short. Context value async_validation set to
+        False validates them during the import instead.
+        :param invoices_data: list of dicts passed to invoice.create
+        :return: generated invoices
+        """
+        invoice_obj = self.env['account.invoice'].with_context(lang='en_US')
+        invoices = invoice_obj
+        for inv_data in invoices_data:
+            invoices |= invoice_obj.create(inv_data)
+        if not invoices:
+            return invoices
+
+        if self.env.context.get('async_validation', True):
+            # Only the invoices created here are given to the jobs, other
+            # draft invoices of the invoicers are left untouched.
+            session = ConnectorSession.from_env(self.env)
+            chunk_size = self.env.context.get(
+                'validation_chunk_size', VALIDATION_CHUNK_SIZE)
+            for invoicer in invoices.mapped('recurring_invoicer_id'):
+                inv_ids = invoices.filtered(
+                    lambda i: i.recurring_invoicer_id == invoicer).ids
+                for i in xrange(0, len(inv_ids), chunk_size):
+                    validate_invoices_job.delay(
+                        session, invoice_obj._name,
+                        inv_ids[i:i + chunk_size], invoicer.id)
+        else:
+            invoices.signal_workflow('invoice_open')
+        return invoices
+
     def _find_product_id(self, ref):
         """ Finds what kind of payment it is,
             based on the reference of the statement line. """
         product_obj = self.env['product.product'].with_context(lang='en_US')
+        cache = self._get_completion_cache()
         payment_type = int(ref[21])
         product = 0
         if payment_type in range(1, 6):
             # Sponsor Gift
-            products = product_obj.search(
-                [('name', '=', GIFT_NAMES[payment_type-1])])
+            products = cache.get(
+                ('gift_product', payment_type), lambda: product_obj.search(
+                    [('name', '=', GIFT_NAMES[payment_type-1])]))
             product = products[0] if products else 0
         elif payment_type in range(6, 8):
             # Fund donation
-            products = product_obj.search(
-                [('fund_id', '=', int(ref[22:26]))])
+            fund_id = int(ref[22:26])
+            products = cache.get(
+                ('fund_product', fund_id), lambda: product_obj.search(
+                    [('fund_id', '=', fund_id)]))
             product = products[0] if products else 0
 
         return product
 
-    def _generate_invoice_line(self, invoice_id, product, st_line, partner_id):
+    def _setup_invoice_line_data(self, product, st_line, partner_id):
+        """ Setup a dict with data passed to invoice_line.create. """
         inv_line_data = {
             'name': product.name,
             'account_id': product.property_account_income.id,
@@ -400,49 +556,243 @@ class StatementCompletionRule(models.Model):
             'quantity': 1,
             'uos_id': False,
             'product_id': product.id or False,
-            'invoice_id': invoice_id,
         }
 
-        res = {}
-
         # Define analytic journal
-        analytic = self.env['account.analytic.default'].account_get(
-            product.id, partner_id, time.strftime('%Y-%m-%d'))
+        today = time.strftime('%Y-%m-%d')
+        analytic = self._get_completion_cache().get(
+            ('analytic', product.id, partner_id, today),
+            lambda: self.env['account.analytic.default'].account_get(
+                product.id, partner_id, today))
         if analytic and analytic.analytic_id:
             inv_line_data['account_analytic_id'] = analytic.analytic_id.id
 
-        res['name'] = product.name
+        return inv_line_data
+
+    def _get_completion_cache(self):
+        """ Returns the cache of the running statement import, or a new
+        cache when rules are called outside of an import. """
+        return self.env.context.get('completion_cache') or CompletionCache()
+
+    def _match_partner_refs(self, st_lines):
+        """ Finds with one search the partners whose reference is given
+        in the reference of the statement lines.
+        :return: tuple (matches, conflicts) where
+                 matches is a dict {line_id: res.partner record} for lines
+                 matching exactly one partner and
+                 conflicts is a dict {line_id: {'name', 'ref',
+                 'partner_ids'}} for lines matching many partners
+        """
+        matches = dict()
+        conflicts = dict()
+        line_refs = dict()
+        for st_line in st_lines:
+            try:
+                line_refs[st_line.id] = str(int(st_line.ref[9:16]))
+            except (TypeError, ValueError):
+                continue
+        if not line_refs:
+            return matches, conflicts
+
+        partners_by_ref = defaultdict(lambda: self.env['res.partner'])
+        for partner in self.env['res.partner'].search(
+                [('ref', 'in', list(set(line_refs.values()))),
+                 ('is_company', '=', False)]):
+            partners_by_ref[partner.ref] |= partner
+        for st_line in st_lines:
+            partners = partners_by_ref.get(line_refs.get(st_line.id))
+            if not partners:
+                continue
+            if len(partners) == 1:
+                matches[st_line.id] = partners
+            else:
+                conflicts[st_line.id] = {
+                    'name': st_line.name,
+                    'ref': st_line.ref,
+                    'partner_ids': partners.ids,
+                }
+        return matches, conflicts
+
+    def _search_partners_by_move_line_refs(self, refs):
+        """ Finds with one query the partner of the most recent move line
+        having each of the given references.
+        :return: dict {ref: res.partner record}
+        """
+        refs = list(set(ref for ref in refs if ref))
+        if not refs:
+            return dict()
+        # Build the query with the ORM to apply access rules
+        move_line_obj = self.env['account.move.line']
+        query = move_line_obj._where_calc(
+            [('ref', 'in', refs), ('partner_id', '!=', None)])
+        move_line_obj._apply_ir_rules(query, 'read')
+        from_clause, where_clause, where_params = query.get_sql()
+        self.env.cr.execute("""
+            SELECT DISTINCT ON ("account_move_line".ref)
+                "account_move_line".ref, "account_move_line".partner_id
+            FROM {0}
+            WHERE {1}
+            ORDER BY "account_move_line".ref,
+                     "account_move_line".date DESC,
+                     "account_move_line".id DESC
+        """.format(from_clause, where_clause or 'true'), where_params)
+        partner_obj = self.env['res.partner']
+        return {ref: partner_obj.browse(partner_id)
+                for ref, partner_id in self.env.cr.fetchall()}
+
+    def _get_sender_name_candidates(self, label):
+        """ Reads the sender of a posted payment in the label of the
+        statement line and returns the (lastname, firstname) pairs it can
+        match, in the order they should be tried. The words before each
+        number of the address (street number, zip) are taken two by two,
+        starting from the number. Composed names are split on hyphens.
+        :return: list of lowercase tuples (lastname, firstname)
+        """
+        res = list()
+        label = (label or '').replace('\n', ' ')
+        for separator in (' EXPÉDITEUR: ', " DONNEUR D'ORDRE: "):
+            sender = label.split(separator.decode('utf8'))
+            if len(sender) > 1:
+                break
+        else:
+            return res
+
+        words = sender[1].replace(',', '').lower().split(' ')
+        names = list()
+        for word in words:
+            if not word.isdigit():
+                names.append(word)
+                continue
+            for i in range(len(names) - 1, 0, -1):
+                firstname = names[i-1]
+                candidates = [(firstname, names[i])]
+                for lastname in names[i].split('-'):
+                    candidates.extend([(lastname, firstname),
+                                       (firstname, lastname)])
+                for candidate in candidates:
+                    if all(candidate) and candidate not in res:
+                        res.append(candidate)
+        return res
 
-        self.env['account.invoice.line'].create(inv_line_data)
+    def _get_partner_name_index(self, lastnames):
+        """ Loads with one query the partners having one of the given
+        lastnames (case insensitive).
+        :return: dict {lowercase lastname: [(lowercase firstname, id)]}
+                 sorted by partner id
+        """
+        res = defaultdict(list)
+        if not lastnames:
+            return res
+        self.env.cr.execute("""
+            SELECT id FROM res_partner WHERE lower(lastname) IN %s
+        """, (tuple(lastnames),))
+        partner_ids = [row[0] for row in self.env.cr.fetchall()]
+        # Search again to apply active flag and access rules
+        partners = self.env['res.partner'].search(
+            [('id', 'in', partner_ids)], order='id')
+        for partner in partners:
+            res[partner.lastname.lower()].append(
+                ((partner.firstname or '').lower(), partner.id))
+        return res
 
+    def _get_open_supplier_invoices(self, amounts, tolerance=0.0):
+        """ Loads with one search the open supplier invoices matching the
+        given amounts.
+        :return: dict {amount in cents: list of invoices} where invoices
+                 keep the default order of invoices
+        """
+        res = defaultdict(list)
+        if not amounts:
+            return res
+        # Search the exact amounts within the tolerance, a single range
+        # from the lowest to the highest amount would load every invoice
+        # in between.
+        cents = set()
+        for amount in amounts:
+            cents.update(self._get_amount_keys(amount, tolerance))
+        invoice_search = [
+            ('type', '=', 'in_invoice'), ('state', '=', 'open'),
+            ('amount_total', 'in', [key / 100.0 for key in cents])]
+        for invoice in self.env['account.invoice'].search(invoice_search):
+            res[int(round(invoice.amount_total * 100))].append(invoice)
         return res
 
+    def _get_amount_keys(self, amount, tolerance=0.0):
+        """ Returns the amounts in cents within the tolerance of the given
+        amount, starting with the exact amount. """
+        cents = int(round(amount * 100))
+        res = [cents]
+        for delta in xrange(1, int(round(tolerance * 100)) + 1):
+            res.extend([cents - delta, cents + delta])
+        return res
+
+    def _get_lsv_dd_strings(self):
+        """ Strings found in the label of LSV and DD credits.
+        Inherit this method to recognize credits of other banks. """
+        return [u'BULLETIN DE VERSEMENT ORANGE',
+                u'ORDRE DEBIT DIRECT',
+                u'Crèdit LSV']
+
     def _search_partner_by_bvr_ref(self, bvr_ref,
                                    search_old_invoices=False):
         """ Finds a partner given its bvr reference. """
-        partner = None
-        contract_group_obj = self.env['recurring.contract.group']
-        contract_groups = contract_group_obj.search(
-            [('bvr_reference', '=', bvr_ref)])
-        if contract_groups:
-            partner = contract_groups[0].partner_id
-        else:
-            # Search open Customer Invoices (with field 'bvr_reference' set)
-            invoice_obj = self.env['account.invoice']
+        return self._search_partners_by_bvr_refs(
+            [bvr_ref], search_old_invoices).get(bvr_ref)
+
+    def _search_partners_by_bvr_refs(self, bvr_refs,
+                                     search_old_invoices=False):
+        """ Finds the partners of many bvr references at once, with one
+        search for each place a reference can be found. A reference is
+        first looked in the contract groups, then in the open customer
+        invoices and at last in the open supplier invoices.
+        :return: dict {bvr_ref: res.partner record}
+        """
+        res = dict()
+        refs = set(ref for ref in bvr_refs if ref)
+        if not refs:
+            return res
+        contract_groups = self.env['recurring.contract.group'].search(
+            [('bvr_reference', 'in', list(refs))])
+        for contract_group in contract_groups:
+            res.setdefault(contract_group.bvr_reference,
+                           contract_group.partner_id)
+
+        # Search open Customer Invoices (with field 'bvr_reference' set)
+        invoice_obj = self.env['account.invoice']
+        refs -= set(res)
+        if refs:
             invoice_search = [
-                ('bvr_reference', '=', bvr_ref),
+                ('bvr_reference', 'in', list(refs)),
                 ('state', '=', 'open')]
             if search_old_invoices:
                 invoice_search[1] = ('state', 'in', ('open', 'cancel',
                                                      'paid'))
-            invoices = invoice_obj.search(invoice_search)
-            if not invoices:
-                # Search open Supplier Invoices (with field 'reference_type'
-                # set to BVR)
-                invoices = invoice_obj.search([
+            for invoice in invoice_obj.search(invoice_search):
+                res.setdefault(invoice.bvr_reference, invoice.partner_id)
+
+        # Search open Supplier Invoices (with field 'reference_type'
+        # set to BVR)
+        refs -= set(res)
+        if refs:
+            for invoice in invoice_obj.search([
                     ('reference_type', '=', 'bvr'),
-                    ('reference', '=', bvr_ref),
-                    ('state', '=', 'open')])
-            if invoices:
-                partner = invoices[0].partner_id
-        return partner
+                    ('reference', 'in', list(refs)),
+                    ('state', '=', 'open')]):
+                res.setdefault(invoice.reference, invoice.partner_id)
+        return res
+
+    def _complete_from_bvr_refs(self, st_lines, search_old_invoices=False):
+        """ Completes the partner of statement lines whose reference
+        matches a bvr reference.
+        :return: dict {line_id: values to write on the statement line}
+        """
+        res = dict()
+        partners = self._search_partners_by_bvr_refs(
+            st_lines.mapped('ref'), search_old_invoices)
+        partner_obj = self.env['res.partner']
+        for st_line in st_lines:
+            partner = partners.get(st_line.ref)
+            if partner:
+                partner = partner_obj._find_accounting_partner(partner)
+                res[st_line.id] = {'partner_id': partner.id}
+        return res
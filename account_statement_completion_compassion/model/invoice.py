@@ -20,6 +20,19 @@ class account_invoice(models.Model):
 
     unrec_items = fields.Integer(related='partner_id.unrec_items')
 
+    def init(self, cr):
+        """ Index used to match debit statement lines by amount. """
+        cr.execute("""
+            SELECT indexname FROM pg_indexes
+            WHERE indexname = 'account_invoice_open_supplier_amount_index'
+        """)
+        if not cr.fetchone():
+            cr.execute("""
+                CREATE INDEX account_invoice_open_supplier_amount_index
+                ON account_invoice (amount_total)
+                WHERE type = 'in_invoice' AND state = 'open'
+            """)
+
     @api.multi
     def show_transactions(self):
         return self.partner_id.show_lines()
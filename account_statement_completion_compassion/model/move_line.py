@@ -0,0 +1,29 @@
+# -*- encoding: utf-8 -*-
+##############################################################################
+#
+#    Copyright (C) 2026 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#    @author: agent <agent@local>
+#
+#    The licence is in the file __openerp__.py
+#
+##############################################################################
+
+from openerp import models
+
+
+class account_move_line(models.Model):
+    """ Adds an index used to find partners from move line references. """
+    _inherit = 'account.move.line'
+
+    def init(self, cr):
+        cr.execute("""
+            SELECT indexname FROM pg_indexes
+            WHERE indexname = 'account_move_line_ref_partner_index'
+        """)
+        if not cr.fetchone():
+            cr.execute("""
+                CREATE INDEX account_move_line_ref_partner_index
+                ON account_move_line (ref, date DESC, id DESC)
+                WHERE partner_id IS NOT NULL
+            """)
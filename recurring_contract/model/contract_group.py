@@ -10,6 +10,7 @@
 ##############################################################################
 
 import logging
+from collections import defaultdict
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 
@@ -21,6 +22,11 @@ from openerp.addons.connector.session import ConnectorSession
 
 logger = logging.getLogger(__name__)
 
+# Number of contract groups generated between two commits in bulk mode
+GENERATION_BATCH_SIZE = 200
+# Number of contract groups given to each asynchronous generation job
+GENERATION_SHARD_SIZE = 1000
+
 
 class contract_group(models.Model):
     _name = 'recurring.contract.group'
@@ -73,19 +79,51 @@ class contract_group(models.Model):
     ##########################################################################
 
     @api.depends('contract_ids.next_invoice_date', 'contract_ids.state')
-    @api.one
+    @api.multi
     def _set_next_invoice_date(self):
-        next_inv_date = min(
-            [c.next_invoice_date for c in self.contract_ids
-             if c.state in self._get_gen_states()] or [False])
-        self.next_invoice_date = next_inv_date
+        """ Takes the minimum date of the contracts with a SQL aggregate,
+        served by the index on (group_id, state, next_invoice_date), instead
+        of loading all contracts of the groups. A contract without date
+        gives an empty group date. """
+        gen_states = self._get_gen_states()
+        next_dates = dict()
+        group_ids = [gid for gid in self.ids if isinstance(gid, (int, long))]
+        for group in self.filtered(lambda g: g.id not in group_ids):
+            # Groups not yet saved, take the contracts in cache
+            next_dates[group.id] = min(
+                [c.next_invoice_date for c in group.contract_ids
+                 if c.state in gen_states] or [False])
+        if group_ids:
+            self.env.cr.execute("""
+                SELECT group_id,
+                       CASE WHEN bool_and(next_invoice_date IS NOT NULL)
+                            THEN min(next_invoice_date) END
+                FROM recurring_contract
+                WHERE group_id IN %s AND state IN %s
+                GROUP BY group_id
+            """, (tuple(group_ids), tuple(gen_states)))
+            next_dates.update(self.env.cr.fetchall())
+        for group in self:
+            group.next_invoice_date = next_dates.get(group.id) or False
 
     @api.multi
     def _set_last_paid_invoice(self):
+        """ Takes the last paid invoice date of the groups with one grouped
+        query, without loading the invoice lines of the contracts. """
+        last_dates = dict()
+        group_ids = [gid for gid in self.ids if isinstance(gid, (int, long))]
+        if group_ids:
+            self.env.cr.execute("""
+                SELECT c.group_id, max(inv.date_invoice)
+                FROM recurring_contract c
+                JOIN account_invoice_line invl ON invl.contract_id = c.id
+                JOIN account_invoice inv ON invl.invoice_id = inv.id
+                WHERE c.group_id IN %s AND invl.state = 'paid'
+                GROUP BY c.group_id
+            """, (tuple(group_ids),))
+            last_dates = dict(self.env.cr.fetchall())
         for group in self:
-            group.last_paid_invoice_date = max(
-                [c.last_paid_invoice_date for c in group.contract_ids] or
-                [False])
+            group.last_paid_invoice_date = last_dates.get(group.id, False)
 
     ##########################################################################
     #                              ORM METHODS                               #
@@ -127,8 +165,12 @@ class contract_group(models.Model):
 
     @api.model
     def validate_invoices(self, invoicer):
+        if invoicer.pending_shards:
+            # Generation jobs are still running, the last one to finish
+            # will validate the invoices.
+            invoicer.auto_validate = True
         # Check if there is invoice waiting for validation
-        if invoicer.invoice_ids:
+        elif invoicer.invoice_ids:
             invoicer.validate_invoices()
 
     @api.multi
@@ -149,7 +191,9 @@ class contract_group(models.Model):
         pass
 
     def generate_invoices(self, invoicer=None):
-        """ By default, launch asynchronous job to perform the task.
+        """ By default, launch asynchronous jobs to perform the task.
+            The groups are split in shards of generation_shard_size groups
+            (context value), each one generated by its own job.
             Context value async_mode set to False can force to perform
             the task immediately.
         """
@@ -158,12 +202,26 @@ class contract_group(models.Model):
                 {'source': self._name})
         if self.env.context.get('async_mode', True):
             session = ConnectorSession.from_env(self.env)
-            generate_invoices_job.delay(
-                session, self._name, self.ids, invoicer.id)
+            shard_size = self.env.context.get(
+                'generation_shard_size', GENERATION_SHARD_SIZE)
+            if shard_size <= 0:
+                # No sharding : all groups are generated by one job
+                shard_size = len(self.ids) or 1
+            shards = [self.ids[i:i + shard_size]
+                      for i in xrange(0, len(self.ids), shard_size)]
+            job_uuids = [
+                generate_invoices_job.delay(
+                    session, self._name, group_ids, invoicer.id)
+                for group_ids in shards]
+            jobs = self.env['queue.job'].search([('uuid', 'in', job_uuids)])
+            invoicer.write({
+                'generation_job_ids': [(4, job.id) for job in jobs]})
         else:
-            # Prevent two generations at the same time
+            # Prevent two generations at the same time. Validation jobs
+            # do not conflict with a generation.
             jobs = self.env['queue.job'].search([
-                ('channel', '=', 'root.recurring_invoicer'),
+                ('channel', 'in', ('root.recurring_invoicer',
+                                   'root.recurring_invoicer.generation')),
                 ('state', '=', 'started')])
             if jobs:
                 raise exceptions.Warning(
@@ -179,53 +237,139 @@ class contract_group(models.Model):
     def _generate_invoices(self, invoicer=None):
         """ Checks all contracts and generate invoices if needed.
         Create an invoice per contract group per date.
+        All billing dates up to the advance billing limit are computed
+        upfront, and the next_invoice_date of each contract is written once
+        after all its invoices are generated.
+        Context value bulk_mode set to True generates the groups by batches
+        of generation_batch_size groups instead of one group at a time.
         """
         logger.info("Invoice generation started.")
         if invoicer is None:
             invoicer = self.env['recurring.invoicer'].create(
                 {'source': self._name})
         inv_obj = self.env['account.invoice']
+        contract_obj = self.env['recurring.contract']
         journal_obj = self.env['account.journal']
-        gen_states = self._get_gen_states()
         journal_ids = journal_obj.search(
             [('type', '=', 'sale'), ('company_id', '=', 1 or False)], limit=1)
+        batch_size = 1
+        if self.env.context.get('bulk_mode'):
+            batch_size = self.env.context.get(
+                'generation_batch_size', GENERATION_BATCH_SIZE)
 
+        group_obj = self.with_context(no_next_date_update=True)
         nb_groups = len(self)
-        count = 1
-        for contract_group in self:
+        for start in xrange(0, nb_groups, batch_size):
+            batch = group_obj[start:start + batch_size]
             logger.info("Generating invoices for group {0}/{1}".format(
-                count, nb_groups))
-            month_delta = contract_group.advance_billing_months or 1
-            limit_date = datetime.today() + relativedelta(months=+month_delta)
-            while True:  # Emulate a do-while loop
-                # contract_group update 'cause next_inv_date has been modified
-                group_inv_date = contract_group.next_invoice_date
-                contracts = self.env['recurring.contract']
-                if group_inv_date and datetime.strptime(group_inv_date,
-                                                        DF) <= limit_date:
-                    contracts = contract_group.contract_ids.filtered(
-                        lambda c: c.next_invoice_date <= group_inv_date and
-                        (not c.end_date or c.end_date >
-                         c.next_invoice_date) and c.state in gen_states)
-                if not contracts:
-                    break
-                inv_data = contract_group._setup_inv_data(journal_ids,
-                                                          invoicer)
-                invoice = inv_obj.create(inv_data)
-                for contract in contracts:
-                    contract_group._generate_invoice_lines(contract, invoice)
-                if invoice.invoice_line:
-                    invoice.button_compute()
-                else:
-                    invoice.unlink()
-
-            # After a contract_group is done, we commit all writes in order to
+                start + len(batch), nb_groups))
+            schedule, next_dates = batch._get_invoicing_schedule()
+            # Prefetch contracts and contract lines that will be invoiced
+            contract_obj.browse(next_dates.keys()).mapped('contract_line_ids')
+            invoices = inv_obj
+            for contract_group in batch:
+                for inv_date, contract_ids in schedule[contract_group.id]:
+                    inv_data = contract_group._setup_inv_data(
+                        journal_ids, invoicer)
+                    inv_data['date_invoice'] = inv_date
+                    # Lines are built in memory and created with the invoice
+                    inv_lines = contract_group._setup_inv_lines_commands(
+                        contract_obj.browse(contract_ids),
+                        inv_obj.new(inv_data))
+                    if inv_lines:
+                        inv_data['invoice_line'] = inv_lines
+                        invoices |= inv_obj.create(inv_data)
+            if invoices:
+                invoices.button_compute()
+
+            contract_obj._write_next_invoice_dates(next_dates)
+
+            # After a batch is done, we commit all writes in order to
             # avoid doing it again in case of an error or a timeout
             self.env.cr.commit()
-            count += 1
         logger.info("Invoice generation successfully finished.")
         return invoicer
 
+    def _get_invoicing_schedule(self):
+        """ Computes, without writing anything, all invoices that the
+        generation would create for the groups.
+        :return: tuple (schedule, next_dates) where
+                 - schedule is a dict {group_id: [(invoice_date,
+                   [contract_ids])]} with dates in chronological order
+                 - next_dates is a dict {contract_id: next_invoice_date}
+                   giving the date of invoiced contracts after generation
+        """
+        schedule = defaultdict(list)
+        next_dates = dict()
+        if not self:
+            return schedule, next_dates
+
+        cr = self.env.cr
+        cr.execute("""
+            SELECT id, advance_billing_months, recurring_unit, recurring_value
+            FROM recurring_contract_group
+            WHERE id IN %s
+        """, (tuple(self.ids),))
+        groups_data = cr.fetchall()
+        cr.execute("""
+            SELECT group_id, id, next_invoice_date, end_date
+            FROM recurring_contract
+            WHERE group_id IN %s AND state IN %s
+            ORDER BY id
+        """, (tuple(self.ids), tuple(self._get_gen_states())))
+        group_contracts = defaultdict(list)
+        for group_id, contract_id, next_date, end_date in cr.fetchall():
+            group_contracts[group_id].append(
+                (contract_id, next_date, end_date))
+
+        # Compute the billing dates of all contracts up to the limit date
+        # of their group
+        today = datetime.today()
+        group_limits = dict()
+        rows = list()
+        limit_dates = dict()
+        for group_id, month_delta, rec_unit, rec_value in groups_data:
+            contracts = group_contracts[group_id]
+            # Like the group next_invoice_date, a contract without
+            # next_invoice_date prevents the generation.
+            if not contracts or not all(c[1] for c in contracts):
+                continue
+            limit_date = (today + relativedelta(
+                months=+(month_delta or 1))).strftime(DF)
+            group_limits[group_id] = limit_date
+            for cid, next_date, end_date in contracts:
+                rows.append((cid, next_date, rec_unit, rec_value))
+                limit_dates[cid] = limit_date
+        billing_dates = self.env['recurring.contract']._get_billing_calendar(
+            rows, limit_dates=limit_dates)
+        # Billing dates of each contract, starting with the current one
+        for cid, next_date, rec_unit, rec_value in rows:
+            billing_dates[cid] = (next_date,) + billing_dates[cid]
+
+        for group_id, limit_date in group_limits.iteritems():
+            contracts = group_contracts[group_id]
+            # Position of each contract in its billing dates
+            index = dict.fromkeys([c[0] for c in contracts], 0)
+            while True:  # Emulate a do-while loop
+                group_inv_date = min(
+                    billing_dates[cid][i] for cid, i in index.iteritems())
+                if group_inv_date > limit_date:
+                    break
+                contract_ids = list()
+                for cid, next_date, end_date in contracts:
+                    contract_date = billing_dates[cid][index[cid]]
+                    if contract_date <= group_inv_date and (
+                            not end_date or end_date > contract_date):
+                        contract_ids.append(cid)
+                if not contract_ids:
+                    break
+                schedule[group_id].append((group_inv_date, contract_ids))
+                for cid in contract_ids:
+                    index[cid] += 1
+                    next_dates[cid] = billing_dates[cid][index[cid]]
+
+        return schedule, next_dates
+
     @api.multi
     def _clean_generate_invoices(self):
         """ Change method which cancels generated invoices and rewinds
@@ -303,6 +447,22 @@ class contract_group(models.Model):
             inv_line_data['account_id'] = account.id
         return inv_line_data
 
+    @api.multi
+    def _setup_inv_lines_commands(self, contracts, invoice):
+        """ Returns the commands creating the invoice lines of the contracts
+        with invoice.create, built with _setup_inv_line_data.
+        :param invoice: invoice not yet created (see models.new)
+        """
+        commands = list()
+        for contract in contracts:
+            for contract_line in contract.contract_line_ids:
+                inv_line_data = self._setup_inv_line_data(
+                    contract_line, invoice)
+                if inv_line_data:
+                    inv_line_data.pop('invoice_id', None)
+                    commands.append((0, 0, inv_line_data))
+        return commands
+
     @api.model
     def _generate_invoice_lines(self, contract, invoice):
         inv_line_obj = self.env['account.invoice.line']
@@ -331,13 +491,21 @@ def related_action_invoicer(session, job):
     return action
 
 
-@job(default_channel='root.recurring_invoicer')
+@job(default_channel='root.recurring_invoicer.generation')
 @related_action(action=related_action_invoicer)
 def generate_invoices_job(session, model_name, group_ids, invoicer_id):
     """Job for generating invoices."""
     groups = session.env[model_name].browse(group_ids)
     invoicer = session.env['recurring.invoicer'].browse(invoicer_id)
     groups._generate_invoices(invoicer)
+    # Checked in another job, which is run once this one is committed
+    generation_done_job.delay(session, invoicer._name, invoicer_id)
+
+
+@job(default_channel='root.recurring_invoicer.validation')
+def generation_done_job(session, model_name, invoicer_id):
+    """Job validating the invoices when all generation jobs are done."""
+    session.env[model_name].browse(invoicer_id).generation_done()
 
 
 @job(default_channel='root.recurring_invoicer')
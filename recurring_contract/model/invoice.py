@@ -40,3 +40,15 @@ class account_invoice_line(models.Model):
                    ('open', 'Open'),
                    ('paid', 'Paid'),
                    ('cancel', 'Cancelled')])
+
+    def init(self, cr):
+        """ Index used to find the invoice lines of contracts. """
+        cr.execute("""
+            SELECT indexname FROM pg_indexes
+            WHERE indexname = 'account_invoice_line_contract_state_index'
+        """)
+        if not cr.fetchone():
+            cr.execute("""
+                CREATE INDEX account_invoice_line_contract_state_index
+                ON account_invoice_line (contract_id, state)
+            """)
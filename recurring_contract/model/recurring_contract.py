@@ -9,8 +9,10 @@
 #
 ##############################################################################
 
+from collections import defaultdict
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+import logging
 
 from openerp import api, exceptions, fields, models, _
 from openerp.tools import DEFAULT_SERVER_DATE_FORMAT as DF
@@ -19,6 +21,10 @@ import openerp.addons.decimal_precision as dp
 from openerp.addons.connector.queue.job import job, related_action
 from openerp.addons.connector.session import ConnectorSession
 
+from .recurring_invoicer import VALIDATION_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
 
 class recurring_contract_line(models.Model):
     """ Each product sold through a contract """
@@ -130,11 +136,25 @@ class recurring_contract(models.Model):
                 line.subtotal for line in contract.contract_line_ids
             ])
 
-    @api.one
+    @api.multi
     def _get_last_paid_invoice(self):
-        self.last_paid_invoice_date = max(
-            [invl.invoice_id.date_invoice for invl in self.invoice_line_ids
-             if invl.state == 'paid'] or [False])
+        """ Takes the last paid invoice date of the contracts with one
+        grouped query, without loading their invoice lines. """
+        last_dates = dict()
+        contract_ids = [
+            cid for cid in self.ids if isinstance(cid, (int, long))]
+        if contract_ids:
+            self.env.cr.execute("""
+                SELECT invl.contract_id, max(inv.date_invoice)
+                FROM account_invoice_line invl
+                JOIN account_invoice inv ON invl.invoice_id = inv.id
+                WHERE invl.contract_id IN %s AND invl.state = 'paid'
+                GROUP BY invl.contract_id
+            """, (tuple(contract_ids),))
+            last_dates = dict(self.env.cr.fetchall())
+        for contract in self:
+            contract.last_paid_invoice_date = last_dates.get(
+                contract.id, False)
 
     def _count_invoices(self):
         for contract in self:
@@ -145,6 +165,18 @@ class recurring_contract(models.Model):
     #                              ORM METHODS                               #
     ##########################################################################
 
+    def init(self, cr):
+        """ Index used to compute the next invoice date of groups. """
+        cr.execute("""
+            SELECT indexname FROM pg_indexes
+            WHERE indexname = 'recurring_contract_group_next_date_index'
+        """)
+        if not cr.fetchone():
+            cr.execute("""
+                CREATE INDEX recurring_contract_group_next_date_index
+                ON recurring_contract (group_id, state, next_invoice_date)
+            """)
+
     @api.model
     def create(self, vals):
         """ Add a sequence generated ref if none is given """
@@ -214,35 +246,61 @@ class recurring_contract(models.Model):
         """ Rewinds the next invoice date of contract after the last
         generated invoice. No open invoices exist after that date. """
         gen_states = self.env['recurring.contract.group']._get_gen_states()
-        for contract in self.with_context(allow_rewind=True):
+        last_invoice_dates = dict()
+        next_dates = dict()
+        for contract in self:
             if contract.state in gen_states:
                 last_invoice_date = max([
-                    datetime.strptime(line.invoice_id.date_invoice, DF) for
+                    line.invoice_id.date_invoice for
                     line in contract.invoice_line_ids
                     if line.state in ('open', 'paid')] or [False])
                 if last_invoice_date:
-                    contract.write({
-                        'next_invoice_date': last_invoice_date.strftime(DF)})
-                    contract.update_next_invoice_date()
+                    last_invoice_dates[contract.id] = last_invoice_date
                 else:
                     # No open/paid invoices, look for cancelled ones
                     next_invoice_date = min([
-                        datetime.strptime(line.invoice_id.date_invoice, DF)
+                        line.invoice_id.date_invoice
                         for line in contract.invoice_line_ids
                         if line.state == 'cancel'] or [False])
                     if next_invoice_date:
-                        contract.write({
-                            'next_invoice_date':
-                            next_invoice_date.strftime(DF)})
-
+                        next_dates[contract.id] = next_invoice_date
+
+        # Next invoice date is one period after the last invoice
+        billing_dates = self.browse(last_invoice_dates.keys()).\
+            get_billing_dates(from_dates=last_invoice_dates)
+        for contract_id, dates in billing_dates.iteritems():
+            next_dates[contract_id] = dates[0]
+        self.with_context(allow_rewind=True)._write_next_invoice_dates(
+            next_dates)
         return True
 
     def update_next_invoice_date(self):
         """ Recompute and set next_invoice date. """
-        next_date = self._compute_next_invoice_date()
-        self.write({'next_invoice_date': next_date})
+        next_dates = dict(
+            (contract_id, dates[0]) for contract_id, dates in
+            self.get_billing_dates().iteritems())
+        self._write_next_invoice_dates(next_dates)
         return True
 
+    @api.multi
+    def get_billing_dates(self, count=1, from_dates=None):
+        """ Returns the next billing dates of the contracts, following
+        their next_invoice_date.
+        :param count: number of billing dates to compute per contract
+        :param from_dates: optional dict {contract_id: date string} giving
+                           the dates to start from instead of the
+                           next_invoice_date of the contracts
+        :return: dict {contract_id: tuple of count date strings}
+        """
+        from_dates = from_dates or dict()
+        rows = [
+            (contract.id, from_dates.get(contract.id,
+                                         contract.next_invoice_date),
+             contract.group_id.recurring_unit,
+             contract.group_id.recurring_value)
+            for contract in self]
+        return self._get_billing_calendar(rows, count=count)
+
     ##########################################################################
     #                             VIEW CALLBACKS                             #
     ##########################################################################
@@ -295,19 +353,32 @@ class recurring_contract(models.Model):
 
     @api.multi
     def contract_terminated(self):
-        today = datetime.today().strftime(DF)
-        self.write({'state': 'terminated', 'end_date': today})
-        self.clean_invoices()
+        """ Contracts already terminated are left untouched : their state
+        was written and their invoices cleaned before moving the workflow
+        (see end_date_reached). """
+        contracts = self.filtered(lambda c: c.state != 'terminated')
+        if contracts:
+            today = datetime.today().strftime(DF)
+            contracts.write({'state': 'terminated', 'end_date': today})
+            contracts.clean_invoices()
         return True
 
     @api.model
     def end_date_reached(self):
+        """ Terminates all expired contracts at once : states are written
+        in one operation and the invoices of all contracts are cleaned in a
+        single pass. The workflow then only moves forward, as
+        contract_terminated does nothing on terminated contracts. """
         today = datetime.today().strftime(DF)
         contracts = self.search([('state', '=', 'active'),
                                  ('end_date', '<=', today)])
 
         if contracts:
+            contracts.write({'state': 'terminated', 'end_date': today})
+            contracts.clean_invoices()
             contracts.signal_workflow('contract_terminated')
+            logger.info("{0} expired contracts terminated.".format(
+                len(contracts)))
 
         return True
 
@@ -323,45 +394,57 @@ class recurring_contract(models.Model):
         """
         inv_lines = self._get_invoice_lines_to_clean(since_date, to_date)
         invoices = inv_lines.mapped('invoice_id')
-        empty_invoices = self.env['account.invoice']
-        to_remove_invl = self.env['account.invoice.line']
-
-        for inv_line in inv_lines:
-            invoice = inv_line.invoice_id
-            # Check if invoice is empty after removing the invoice_lines
-            # of the given contract
-            if invoice not in empty_invoices:
-                remaining_lines = invoice.invoice_line.filtered(
-                    lambda l: not l.contract_id or l.contract_id not in self)
-                if remaining_lines:
-                    # We can move or remove the line
-                    to_remove_invl |= inv_line
-                else:
-                    # The invoice would be empty if we remove the line
-                    empty_invoices |= invoice
+        if not invoices:
+            return invoices
+
+        # Find with one query the invoices that would be empty after
+        # removing the invoice_lines of the given contracts
+        self.env.cr.execute("""
+            SELECT invoice_id
+            FROM account_invoice_line
+            WHERE invoice_id IN %s
+            GROUP BY invoice_id
+            HAVING bool_and(contract_id IS NOT NULL AND contract_id IN %s)
+        """, (tuple(invoices.ids), tuple(self.ids)))
+        empty_ids = [row[0] for row in self.env.cr.fetchall()]
+        empty_invoices = invoices.filtered(lambda i: i.id in empty_ids)
+        # In the other invoices, we can move or remove the lines
+        to_remove_invl = inv_lines.filtered(
+            lambda l: l.invoice_id.id not in empty_ids)
 
         if keep_lines:
             self._move_cancel_lines(to_remove_invl, keep_lines)
         else:
             to_remove_invl.unlink()
 
-        # Refresh cache before calling workflows
-        self.env.invalidate_all()
+        # Refresh cache of modified records before calling workflows
+        invoices.invalidate_cache(ids=invoices.ids)
+        inv_lines.invalidate_cache(ids=inv_lines.ids)
+        self.invalidate_cache(['invoice_line_ids'], self.ids)
         # Invoices to set back in open state
         renew_invs = invoices - empty_invoices
         self._cancel_confirm_invoices(invoices, renew_invs, keep_lines)
 
+        logger.info(
+            "Cleaned {0} invoice lines of {1} contracts : {2} invoices "
+            "cancelled, {3} invoices updated.".format(
+                len(inv_lines), len(self), len(empty_invoices),
+                len(renew_invs)))
         return invoices
 
     @api.one
     def _on_contract_lines_changed(self):
         """Update related invoices to reflect the changes to the contract.
+        Only the invoices whose lines differ from what the contract now
+        generates are cancelled, updated and validated again.
         """
         inv_lines = self.env['account.invoice.line'].search(
             [('contract_id', '=', self.id),
              ('state', 'not in', ('paid', 'cancel'))])
 
-        invoices = inv_lines.mapped('invoice_id')
+        invoices = self._get_outdated_invoices(inv_lines.mapped('invoice_id'))
+        if not invoices:
+            return
         invoices.action_cancel()
         invoices.action_cancel_draft()
         self._update_invoice_lines(invoices)
@@ -375,25 +458,28 @@ class recurring_contract(models.Model):
                   and does not update related move lines.
         """
         invoice_obj = self.env['account.invoice']
-        invoices_copy = dict()
+        cancel_invoices = invoice_obj
+        lines_by_invoice = defaultdict(list)
         for invoice_line in invoice_lines:
-            invoice = invoice_line.invoice_id
-            copy_invoice_id = invoices_copy.get(invoice.id)
-            if not copy_invoice_id:
-                copy_invoice_id = invoice.copy({
-                    'date_invoice': invoice.date_invoice,
-                    'date_due': invoice.date_invoice}).id
-                # Empty the new invoice
-                cancel_lines = self.env['account.invoice.line'].search([
-                    ('invoice_id', '=', copy_invoice_id)])
-                cancel_lines.unlink()
-                invoices_copy[invoice.id] = copy_invoice_id
-
-            # Move the line in the invoice copy
-            invoice_line.write({'invoice_id': copy_invoice_id})
+            lines_by_invoice[invoice_line.invoice_id.id].append(
+                invoice_line.id)
+
+        # Copies are created empty, without tracking and creation messages
+        for invoice in invoice_obj.with_context(
+                mail_create_nolog=True, mail_notrack=True).browse(
+                lines_by_invoice.keys()):
+            copy_invoice = invoice.copy({
+                'date_invoice': invoice.date_invoice,
+                'date_due': invoice.date_invoice,
+                'invoice_line': [],
+                'tax_line': []})
+            cancel_invoices |= copy_invoice
+
+            # Move the lines in the invoice copy
+            invoice_lines.browse(lines_by_invoice[invoice.id]).write(
+                {'invoice_id': copy_invoice.id})
 
         # Compute and cancel invoice copies
-        cancel_invoices = invoice_obj.browse(invoices_copy.values())
         cancel_invoices.button_compute(set_total=True)
         cancel_invoices.signal_workflow('invoice_cancel')
         for ci in cancel_invoices:
@@ -405,26 +491,75 @@ class recurring_contract(models.Model):
     def _cancel_confirm_invoices(self, invoice_cancel, invoice_confirm,
                                  keep_lines=None):
         """ Cancels given invoices and validate again given invoices.
-            confirm_ids must be a subset of cancel_ids ! """
+            confirm_ids must be a subset of cancel_ids !
+            Invoices are validated by chunks of validation_chunk_size
+            (context value). """
         invoice_cancel.signal_workflow('invoice_cancel')
-        invoice_confirm.action_cancel_draft()
-        invoice_confirm.signal_workflow('invoice_open')
+        chunk_size = self.env.context.get(
+            'validation_chunk_size', VALIDATION_CHUNK_SIZE)
+        for i in xrange(0, len(invoice_confirm), chunk_size):
+            chunk = invoice_confirm[i:i + chunk_size]
+            chunk.action_cancel_draft()
+            chunk.signal_workflow('invoice_open')
 
     def _compute_next_invoice_date(self):
         """ Compute next_invoice_date for a single contract. """
-        next_date = datetime.strptime(self.next_invoice_date, DF)
-        rec_unit = self.group_id.recurring_unit
-        rec_value = self.group_id.recurring_value
+        return self.get_billing_dates()[self.id][0]
+
+    @api.model
+    def _get_billing_calendar(self, rows, count=None, limit_dates=None):
+        """ Computes the billing dates of many recurrences at once.
+        Recurrences are grouped by (unit, value), so that the offsets from
+        the start dates are computed only once per group. Dates are
+        computed directly from the start date, except for months and years
+        starting after the 28th, where the day can shrink along the way
+        (ex: 31.01 -> 28.02 -> 28.03).
+        :param rows: list of tuples (key, start date, rec_unit, rec_value)
+        :param count: number of dates to compute after each start date
+        :param limit_dates: dict {key: date string}, computes the dates up
+                            to the limit date of the key and the first date
+                            after it, instead of a fixed count of dates.
+        :return: dict {key: tuple of date strings after the start date}
+        """
+        limit_dates = limit_dates or dict()
+        recurrences = defaultdict(list)
+        for key, date, rec_unit, rec_value in rows:
+            recurrences[rec_unit, rec_value].append(
+                (key, datetime.strptime(date, DF)))
+
+        res = dict()
+        for (rec_unit, rec_value), starts in recurrences.iteritems():
+            delta = self._get_recurring_delta(rec_unit, rec_value)
+            offsets = list()
+            for key, start in starts:
+                limit = limit_dates.get(key)
+                limit = limit and datetime.strptime(limit, DF)
+                closed_form = rec_unit in ('day', 'week') or start.day <= 28
+                dates = list()
+                date = start
+                while (limit and date <= limit) or \
+                        (not limit and len(dates) < count):
+                    if closed_form:
+                        if len(offsets) == len(dates):
+                            offsets.append(delta * (len(dates) + 1))
+                        date = start + offsets[len(dates)]
+                    else:
+                        date = date + delta
+                    dates.append(date)
+                res[key] = tuple(d.strftime(DF) for d in dates)
+        return res
+
+    @api.model
+    def _get_recurring_delta(self, rec_unit, rec_value):
+        """ Returns the relativedelta between two billing dates. """
         if rec_unit == 'day':
-            next_date = next_date + relativedelta(days=+rec_value)
+            return relativedelta(days=+rec_value)
         elif rec_unit == 'week':
-            next_date = next_date + relativedelta(weeks=+rec_value)
+            return relativedelta(weeks=+rec_value)
         elif rec_unit == 'month':
-            next_date = next_date + relativedelta(months=+rec_value)
+            return relativedelta(months=+rec_value)
         else:
-            next_date = next_date + relativedelta(years=+rec_value)
-
-        return next_date.strftime(DF)
+            return relativedelta(years=+rec_value)
 
     @api.one
     def _update_invoice_lines(self, invoices):
@@ -449,6 +584,84 @@ class recurring_contract(models.Model):
             old_lines.unlink()
             group_obj._generate_invoice_lines(self, invoice)
 
+    def _get_outdated_invoices(self, invoices):
+        """ Returns the invoices whose payment term or lines of the contract
+        differ from the ones the contract would generate now. """
+        group_obj = self.env['recurring.contract.group']
+        payment_term = self.group_id.payment_term_id
+        outdated = self.env['account.invoice']
+        for invoice in invoices:
+            lines_data = list()
+            for contract_line in self.contract_line_ids:
+                inv_line_data = group_obj._setup_inv_line_data(
+                    contract_line, invoice)
+                if inv_line_data:
+                    lines_data.append(inv_line_data)
+            lines = invoice.invoice_line.filtered(
+                lambda line: line.contract_id.id == self.id)
+            if invoice.payment_term != payment_term or \
+                    not self._same_invoice_lines(lines, lines_data):
+                outdated |= invoice
+        return outdated
+
+    def _same_invoice_lines(self, lines, lines_data):
+        """ Tells if the given invoice lines hold the values of lines_data,
+        a list of dicts passed to invoice_line.create, in any order. """
+        if len(lines) != len(lines_data):
+            return False
+        fnames = set()
+        for inv_line_data in lines_data:
+            fnames.update(inv_line_data.keys())
+        fnames.discard('invoice_id')
+        line_fields = self.env['account.invoice.line']._fields
+        x2many_fnames = set(
+            fname for fname in fnames
+            if line_fields[fname].type in ('one2many', 'many2many'))
+
+        def line_values(line):
+            values = list()
+            for fname in sorted(fnames):
+                value = line[fname]
+                if fname in x2many_fnames:
+                    value = tuple(sorted(value.ids))
+                elif isinstance(value, models.BaseModel):
+                    value = value.id
+                values.append(value)
+            return values
+
+        def data_values(inv_line_data):
+            values = list()
+            for fname in sorted(fnames):
+                value = inv_line_data.get(fname, False)
+                if fname in x2many_fnames:
+                    value = self._get_x2many_command_ids(value)
+                values.append(value)
+            return values
+
+        existing = sorted(line_values(line) for line in lines)
+        expected = sorted(
+            data_values(inv_line_data) for inv_line_data in lines_data)
+        return existing == expected
+
+    @api.model
+    def _get_x2many_command_ids(self, commands):
+        """ Returns the sorted tuple of ids that the given x2many commands
+        link, or None if the commands create, update or remove records,
+        in which case the lines cannot be compared. """
+        ids = set()
+        for command in commands or []:
+            if isinstance(command, (int, long)):
+                ids.add(command)
+            elif command[0] == 6:
+                ids = set(command[2])
+            elif command[0] == 4:
+                ids.add(command[1])
+            elif command[0] == 5:
+                ids = set()
+            else:
+                return None
+        return tuple(sorted(ids))
+
     @api.one
     def _on_change_next_invoice_date(self, new_invoice_date):
         new_invoice_date = datetime.strptime(new_invoice_date, DF)
@@ -460,6 +673,16 @@ class recurring_contract(models.Model):
                     'Error', _('You cannot rewind the next invoice date.'))
         return True
 
+    def _write_next_invoice_dates(self, next_dates):
+        """ Writes the given {contract_id: date} next invoice dates, with
+        one write per distinct date. """
+        contracts_by_date = defaultdict(list)
+        for contract_id, next_date in next_dates.iteritems():
+            contracts_by_date[next_date].append(contract_id)
+        for next_date, contract_ids in contracts_by_date.iteritems():
+            self.browse(contract_ids).write({'next_invoice_date': next_date})
+        return True
+
     def _get_invoice_lines_to_clean(self, since_date, to_date):
         """ Find all unpaid invoice lines in the given period. """
         invl_search = [('contract_id', 'in', self.ids),
@@ -14,10 +14,18 @@ from datetime import datetime
 from openerp import api, exceptions, fields, models, _
 from openerp.tools import DEFAULT_SERVER_DATE_FORMAT as DF
 
+from openerp.addons.connector.queue.job import job, related_action
+from openerp.addons.connector.session import ConnectorSession
+
+from .contract_group import related_action_invoicer
+
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Number of invoices validated between two commits
+VALIDATION_CHUNK_SIZE = 100
+
 
 class recurring_invoicer(models.Model):
     ''' An invoicer holds a bunch of invoices that have been generated
@@ -35,29 +43,87 @@ class recurring_invoicer(models.Model):
     invoice_ids = fields.One2many(
         'account.invoice', 'recurring_invoicer_id',
         'Generated invoices')
+    generation_job_ids = fields.Many2many(
+        'queue.job', string='Generation jobs', readonly=True)
+    pending_shards = fields.Integer(
+        'Running generation jobs', compute='_compute_shards')
+    failed_shards = fields.Integer(
+        'Failed generation jobs', compute='_compute_shards')
+    auto_validate = fields.Boolean(
+        help='Validate the invoices when all generation jobs are done.')
 
     def calculate_id(self):
         return self.env['ir.sequence'].next_by_code('rec.invoicer.ident')
 
+    @api.one
+    @api.depends('generation_job_ids.state')
+    def _compute_shards(self):
+        jobs = self.generation_job_ids
+        self.failed_shards = len(jobs.filtered(
+            lambda job: job.state == 'failed'))
+        self.pending_shards = len(jobs.filtered(
+            lambda job: job.state != 'done')) - self.failed_shards
+
     @api.one
     def validate_invoices(self):
-        ''' Validates created invoices (set state from draft to open)'''
-        invoice_to_validate = self.invoice_ids.filtered(
-            lambda invoice: invoice.state == 'draft')
+        ''' Validates created invoices (set state from draft to open).
+        Invoices are validated by chunks of validation_chunk_size (context
+        value). Context value async_validation set to True validates each
+        chunk in its own job instead of doing it immediately.
+        While generation jobs are running, the validation is postponed to
+        the end of the generation, to avoid validating only a part of the
+        invoices.
+        '''
+        if self.pending_shards:
+            self.auto_validate = True
+            return self.env['account.invoice']
+        invoice_to_validate = self._get_invoices_to_validate()
+        chunk_size = self.env.context.get(
+            'validation_chunk_size', VALIDATION_CHUNK_SIZE)
+        chunks = [invoice_to_validate[i:i + chunk_size]
+                  for i in xrange(0, len(invoice_to_validate), chunk_size)]
+
+        if self.env.context.get('async_validation'):
+            session = ConnectorSession.from_env(self.env)
+            for chunk in chunks:
+                validate_invoices_job.delay(
+                    session, chunk._name, chunk.ids, self.id)
+            return invoice_to_validate
 
         logger.info("Invoice validation started.")
-        count = 1
+        count = 0
         nb_invoice = len(invoice_to_validate)
-        for invoice in invoice_to_validate:
-            logger.info("Validating invoice {0}/{1}".format(
-                        count, nb_invoice))
-            invoice.signal_workflow('invoice_open')
-            # After an invoice is validated, we commit all writes in order to
+        for chunk in chunks:
+            chunk.signal_workflow('invoice_open')
+            count += len(chunk)
+            # After a chunk is validated, we commit all writes in order to
             # avoid doing it again in case of an error or a timeout
             self.env.cr.commit()
-            count += 1
+            logger.info("Validated invoices {0}/{1}".format(
+                count, nb_invoice))
         return invoice_to_validate
 
+    @api.multi
+    def generation_done(self):
+        ''' Called after each generation job is committed. Validates the
+        invoices if it was requested and all generation jobs are done.
+        The state of the jobs is read instead of maintaining a counter, so
+        that parallel jobs never update the invoicer. A failed job keeps
+        the invoices in draft until it is run again successfully. '''
+        self.ensure_one()
+        if self.failed_shards:
+            logger.warning(
+                "{0} generation jobs of invoicer {1} failed, the invoices "
+                "will not be validated until they are done.".format(
+                    self.failed_shards, self.identifier))
+        elif not self.pending_shards and self.auto_validate:
+            # Clearing the flag writes on the invoicer : when two jobs
+            # finish together, the second one gets a serialization error
+            # and is retried, then finds nothing to validate.
+            self.auto_validate = False
+            self.validate_invoices()
+        return True
+
     @api.one
     def cancel_invoices(self):
         ''' Cancel created invoices (set state from open to cancelled) '''
@@ -70,3 +136,23 @@ class recurring_invoicer(models.Model):
         invoice_to_cancel.signal_workflow('invoice_cancel')
 
         return True
+
+    def _get_invoices_to_validate(self):
+        ''' Returns the draft invoices of the invoicer. Invoices of chunks
+        already committed are open, so an interrupted validation resumes
+        with the remaining ones. '''
+        return self.env['account.invoice'].search([
+            ('recurring_invoicer_id', '=', self.id),
+            ('state', '=', 'draft')], order='id')
+
+
+##############################################################################
+#                            CONNECTOR METHODS                               #
+##############################################################################
+@job(default_channel='root.recurring_invoicer.validation')
+@related_action(action=related_action_invoicer)
+def validate_invoices_job(session, model_name, invoice_ids, invoicer_id):
+    """Job for validating generated invoices."""
+    invoices = session.env[model_name].browse(invoice_ids).filtered(
+        lambda invoice: invoice.state == 'draft')
+    invoices.signal_workflow('invoice_open')
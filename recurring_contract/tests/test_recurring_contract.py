@@ -10,8 +10,10 @@
 ##############################################################################
 
 from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
 from test_base_contract import test_base_contract
 from openerp.tools import DEFAULT_SERVER_DATE_FORMAT as DF
+from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT as DTF
 from openerp import fields
 import logging
 logger = logging.getLogger(__name__)
@@ -219,3 +221,258 @@ class test_recurring_contract(test_base_contract):
             original_price - contract3.total_amount,
             invoice.amount_total)
         self.assertEqual(original_start_date, invoice2.date_invoice)
+
+    def test_bulk_generation(self):
+        """
+            Test that the bulk generation mode creates the same invoices as
+            the standard generation and updates the next invoice dates.
+        """
+        def create_group(partner_id):
+            group = self._create_group(
+                'do_nothing', partner_id, 2, self.payment_term_id,
+                other_vals={'recurring_value': 1, 'recurring_unit': 'month'})
+            contracts = self.env['recurring.contract']
+            for price in ('40.0', '60.0'):
+                contract = self._create_contract(
+                    datetime.today().strftime(DF), group,
+                    datetime.today().strftime(DF))
+                self._create_contract_line(contract.id, price)
+                contracts |= contract
+            contracts.signal_workflow('contract_validated')
+            return group, contracts
+
+        def invoices_values(invoicer):
+            return sorted(
+                (invoice.date_invoice, invoice.amount_untaxed,
+                 sorted(invoice.invoice_line.mapped('price_subtotal')))
+                for invoice in invoicer.invoice_ids)
+
+        group, contracts = create_group(self.partners.ids[1])
+        bulk_group, bulk_contracts = create_group(self.partners.ids[2])
+        invoicer = group.with_context(async_mode=False).generate_invoices()
+        bulk_invoicer = bulk_group.with_context(
+            async_mode=False, bulk_mode=True).generate_invoices()
+
+        # One invoice per month, including both contracts
+        self.assertEqual(len(bulk_invoicer.invoice_ids), 3)
+        for invoice in bulk_invoicer.invoice_ids:
+            self.assertEqual(invoice.amount_untaxed, 100.0)
+        self.assertEqual(
+            invoices_values(bulk_invoicer), invoices_values(invoicer))
+        self.assertEqual(
+            bulk_contracts.mapped('next_invoice_date'),
+            contracts.mapped('next_invoice_date'))
+        self.assertEqual(
+            bulk_group.next_invoice_date, group.next_invoice_date)
+        last_date = max(bulk_invoicer.invoice_ids.mapped('date_invoice'))
+        self.assertTrue(bulk_group.next_invoice_date > last_date)
+
+    def _step_dates(self, start, count, **delta):
+        """ Returns the count dates following start, computed period by
+        period. """
+        dates = list()
+        date = datetime.strptime(start, DF)
+        for i in range(count):
+            date += relativedelta(**delta)
+            dates.append(date.strftime(DF))
+        return tuple(dates)
+
+    def test_billing_calendar_end_of_month(self):
+        """
+            Test that monthly and yearly recurrences starting after the 28th
+            keep the day reached at the end of a short month.
+        """
+        contract_obj = self.env['recurring.contract']
+        calendar = contract_obj._get_billing_calendar(
+            [('month', '2015-01-31', 'month', 1),
+             ('year', '2016-02-29', 'year', 1),
+             ('middle', '2015-01-15', 'month', 1)], count=3)
+        self.assertEqual(
+            calendar['month'], ('2015-02-28', '2015-03-28', '2015-04-28'))
+        self.assertEqual(
+            calendar['year'], ('2017-02-28', '2018-02-28', '2019-02-28'))
+        self.assertEqual(
+            calendar['middle'], ('2015-02-15', '2015-03-15', '2015-04-15'))
+
+        # With a limit date, the first date after the limit is included
+        calendar = contract_obj._get_billing_calendar(
+            [('month', '2015-01-31', 'month', 1)],
+            limit_dates={'month': '2015-03-15'})
+        self.assertEqual(calendar['month'], ('2015-02-28', '2015-03-28'))
+
+    def test_billing_calendar_weekly(self):
+        """
+            Test the billing dates of weekly recurrences.
+        """
+        calendar = self.env['recurring.contract']._get_billing_calendar(
+            [(1, '2015-01-01', 'week', 2)], count=3)
+        self.assertEqual(
+            calendar[1], ('2015-01-15', '2015-01-29', '2015-02-12'))
+
+        start_date = datetime.today().strftime(DF)
+        group = self._create_group(
+            'do_nothing', self.partners.ids[0], 1, self.payment_term_id,
+            other_vals={'recurring_value': 1, 'recurring_unit': 'week'})
+        contract = self._create_contract(start_date, group, start_date)
+        billing_dates = contract.get_billing_dates(count=4)
+        self.assertEqual(
+            billing_dates[contract.id],
+            self._step_dates(start_date, 4, weeks=1))
+
+    def test_advance_billing_year(self):
+        """
+            Test the generation of twelve months of advance billing.
+        """
+        start_date = datetime.today().strftime(DF)
+        group = self._create_group(
+            'do_nothing', self.partners.ids[0], 12, self.payment_term_id,
+            other_vals={'recurring_value': 1, 'recurring_unit': 'month'})
+        contract = self._create_contract(start_date, group, start_date)
+        self._create_contract_line(contract.id, '40.0')
+        contract.signal_workflow('contract_validated')
+
+        invoicer = group.with_context(async_mode=False).generate_invoices()
+        next_dates = self._step_dates(start_date, 13, months=1)
+        self.assertEqual(
+            sorted(invoicer.invoice_ids.mapped('date_invoice')),
+            [start_date] + list(next_dates[:-1]))
+        self.assertEqual(contract.next_invoice_date, next_dates[-1])
+
+    def test_end_date_in_advance_window(self):
+        """
+            Test that no invoice is generated after the end date of a
+            contract, even if the advance billing goes further.
+        """
+        start_date = datetime.today().strftime(DF)
+        end_date = datetime.today() + relativedelta(months=2, days=1)
+        group = self._create_group(
+            'do_nothing', self.partners.ids[0], 12, self.payment_term_id,
+            other_vals={'recurring_value': 1, 'recurring_unit': 'month'})
+        contract = self._create_contract(
+            start_date, group, start_date,
+            other_vals={'end_date': end_date.strftime(DTF)})
+        self._create_contract_line(contract.id, '40.0')
+        contract.signal_workflow('contract_validated')
+
+        invoicer = group.with_context(async_mode=False).generate_invoices()
+        next_dates = self._step_dates(start_date, 3, months=1)
+        self.assertEqual(
+            sorted(invoicer.invoice_ids.mapped('date_invoice')),
+            [start_date] + list(next_dates[:-1]))
+
+    def test_rewind_next_invoice_date(self):
+        """
+            Test that the next invoice date goes back after the last open
+            invoice when invoices are cleaned, or to the first cancelled
+            invoice when no open invoice remains.
+        """
+        start_date = datetime.today().strftime(DF)
+        group = self._create_group(
+            'do_nothing', self.partners.ids[0], 2, self.payment_term_id,
+            other_vals={'recurring_value': 1, 'recurring_unit': 'month'})
+        contract = self._create_contract(start_date, group, start_date)
+        self._create_contract_line(contract.id, '40.0')
+        contract.signal_workflow('contract_validated')
+        contract.button_generate_invoices()
+        next_dates = self._step_dates(start_date, 3, months=1)
+        self.assertEqual(contract.next_invoice_date, next_dates[-1])
+
+        # Cancel the invoices after the first one
+        contract._clean_invoices(since_date=next_dates[0])
+        contract.rewind_next_invoice_date()
+        self.assertEqual(contract.next_invoice_date, next_dates[0])
+
+        # Cancel all invoices
+        contract._clean_invoices()
+        contract.rewind_next_invoice_date()
+        self.assertEqual(contract.next_invoice_date, start_date)
+
+    def test_end_date_reached(self):
+        """
+            Test that the expired contracts are terminated together, with
+            only one job cleaning their invoices.
+        """
+        start_date = datetime.today().strftime(DF)
+        end_date = datetime.today() - timedelta(days=1)
+        group = self._create_group(
+            'do_nothing', self.partners.ids[0], 1, self.payment_term_id,
+            other_vals={'recurring_value': 1, 'recurring_unit': 'month'})
+        contracts = self.env['recurring.contract']
+        for price in ('40.0', '60.0', '80.0'):
+            contract = self._create_contract(
+                start_date, group, start_date,
+                other_vals={'end_date': end_date.strftime(DTF)})
+            self._create_contract_line(contract.id, price)
+            contracts |= contract
+        contracts.signal_workflow('contract_validated')
+
+        date_finish = fields.Datetime.now()
+        self.env['recurring.contract'].end_date_reached()
+        for contract in contracts:
+            self.assertEqual(contract.state, 'terminated')
+        clean_jobs = self.env['queue.job'].search([
+            ('name', '=', 'Job for cleaning invoices of contracts.'),
+            ('date_created', '>=', date_finish)])
+        self.assertEqual(len(clean_jobs), 1)
+
+    def _create_invoiced_contract(self, partner_id, price):
+        """ Creates an active contract with three open invoices. """
+        start_date = datetime.today().strftime(DF)
+        group = self._create_group(
+            'do_nothing', partner_id, 2, self.payment_term_id,
+            other_vals={'recurring_value': 1, 'recurring_unit': 'month'})
+        contract = self._create_contract(start_date, group, start_date)
+        self._create_contract_line(contract.id, price)
+        contract.signal_workflow('contract_validated')
+        contract.button_generate_invoices()
+        invoices = contract.invoice_line_ids.mapped('invoice_id')
+        self.assertEqual(len(invoices), 3)
+        self.assertEqual(set(invoices.mapped('state')), set(['open']))
+        return contract, invoices
+
+    def test_contract_lines_unchanged(self):
+        """
+            Test that rewriting the contract lines with the same values
+            keeps the open invoices untouched.
+        """
+        contract, invoices = self._create_invoiced_contract(
+            self.partners.ids[0], '40.0')
+        moves = {invoice.id: invoice.move_id.id for invoice in invoices}
+
+        contract_line = contract.contract_line_ids
+        contract.write({'contract_line_ids': [
+            (1, contract_line.id, {'amount': contract_line.amount,
+                                   'quantity': contract_line.quantity})]})
+        self.env.invalidate_all()
+        for invoice in invoices:
+            self.assertEqual(invoice.state, 'open')
+            self.assertEqual(invoice.move_id.id, moves[invoice.id])
+            self.assertEqual(invoice.amount_total, 40.0)
+
+    def test_contract_lines_changed(self):
+        """
+            Test that changing the amount of a contract only updates the
+            unpaid invoices of this contract.
+        """
+        contract, invoices = self._create_invoiced_contract(
+            self.partners.ids[0], '40.0')
+        other_contract, other_invoices = self._create_invoiced_contract(
+            self.partners.ids[1], '40.0')
+        paid_invoice = invoices.sorted(key=lambda i: i.date_invoice)[0]
+        paid_invoice.confirm_paid()
+        moves = {invoice.id: invoice.move_id.id
+                 for invoice in invoices | other_invoices}
+
+        contract.write({'contract_line_ids': [
+            (1, contract.contract_line_ids.id, {'amount': 50.0})]})
+        self.env.invalidate_all()
+        self.assertEqual(paid_invoice.amount_total, 40.0)
+        self.assertEqual(paid_invoice.move_id.id, moves[paid_invoice.id])
+        for invoice in invoices - paid_invoice:
+            self.assertEqual(invoice.state, 'open')
+            self.assertEqual(invoice.amount_total, 50.0)
+            self.assertNotEqual(invoice.move_id.id, moves[invoice.id])
+        for invoice in other_invoices:
+            self.assertEqual(invoice.state, 'open')
+            self.assertEqual(invoice.amount_total, 40.0)
+            self.assertEqual(invoice.move_id.id, moves[invoice.id])